@@ -1,25 +1,324 @@
-from facenet_pytorch import InceptionResnetV1, MTCNN
 from PIL import Image
-import torchvision.transforms as transforms
 import numpy as np
 import pandas as pd
 import os
+import sys
+import glob
+import argparse
+import time
+import atexit
+import json
+import multiprocessing
 import torch
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from face_cache import CropCache, EmbeddingCache, FailureRegistry, config_hash, file_hash, read_json, replacing, write_json
+from facenet_backends import compile_facenet, quantize_int8, trace_facenet, warm_up
+from run_manifest import ROW_COLUMNS, hash_images, load_manifest, row_keys, save_manifest
+from stage_profiler import StageProfiler
+from stimulus_bundle import open_bundle
+from trial_scoring import METRICS, cached_distance_matrix, score_lineups, score_trials
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-facenet = InceptionResnetV1(pretrained='vggface2').eval().to(device)
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+# default image root: the stimuli shipped in IMAGES/, or the code directory itself when the images
+# are laid out next to the code as the instructions describe
+FILE_PATH = os.path.join(CODE_DIR, 'IMAGES') if os.path.isdir(os.path.join(CODE_DIR, 'IMAGES')) else CODE_DIR
+
+FACENET_WEIGHTS = 'vggface2'
+# local copy of the vggface2 state_dict, written on first download and memory-mapped afterwards
+WEIGHTS_DIR = os.path.join(CODE_DIR, 'weights')
+FACENET_WEIGHTS_PATH = os.path.join(WEIGHTS_DIR, '20180402-114759-vggface2.pt')
+# the same weights without the 8631-way vggface2 classifier, which the 512-d embedding never uses;
+# the slim model is built without that layer at all and gives bit-identical embeddings
+FACENET_SLIM_WEIGHTS_PATH = os.path.join(WEIGHTS_DIR, '20180402-114759-vggface2-embedding.pt')
+FACENET_SLIM = True
+
+# 'eager' runs the float32 model as is, 'int8' a statically quantised copy (CPU only) that is
+# calibrated on the stimulus face crops saved at CALIBRATION_PATH, 'torchscript' a traced and
+# frozen model saved in WEIGHTS_DIR, 'compiled' a torch.compile model whose kernels are cached
+# in WEIGHTS_DIR; the last two run one fixed batch shape of EMBED_BATCH_SIZE crops
+FACENET_BACKENDS = ('eager', 'int8', 'torchscript', 'compiled')
+FACENET_BACKEND = 'eager'
+# facenet runs under cpu/cuda autocast in the lower precisions, embeddings always come back float32;
+# bfloat16 is fast on cpus with avx512_bf16/amx, float16 is mainly useful on gpus
+FACENET_PRECISIONS = ('float32', 'bfloat16', 'float16')
+FACENET_PRECISION = 'float32'
+CALIBRATION_PATH = os.path.join(WEIGHTS_DIR, 'calibration_crops.pt')
 
 # - set margin=20 to include more background around the face, helping FaceNet handle a very tight crop
 # - lowered thresholds to [0.2, 0.3, 0.4] to make detection stages more lenient, increasing the chance of detecting obscured faces
 # changes were chosen based on visual inspection of failed detections in images
-mtcnn = MTCNN(image_size=160, margin=20, thresholds=[0.2, 0.3, 0.4], post_process=True)
+MTCNN_SETTINGS = dict(image_size=160, margin=20, thresholds=[0.2, 0.3, 0.4], post_process=True)
+
+# detection retry ladder: every image is first run with MTCNN_SETTINGS, then only the images still
+# without a face are retried with each later tier in turn; a tier overrides MTCNN_SETTINGS and can
+# upscale the image first. the loose tiers cost ~4x the first per image, so they are only paid for
+# the few hard images (on the stimuli: suspect25, then innocent12 upscaled, then suspect23)
+DETECTION_TIERS = [
+    {},
+    {'thresholds': [0.1, 0.2, 0.3], 'min_face_size': 12},
+    {'thresholds': [0.1, 0.2, 0.3], 'upscale': 2},
+    {'thresholds': [0.05, 0.1, 0.2], 'min_face_size': 12}
+]
+
+# embeddings persist across runs, keyed by image content and the settings that produced them
+CACHE_DIR = os.path.join(FILE_PATH, 'embedding_cache')
+
+# number of equal-sized images passed to mtcnn in one call
+DETECT_BATCH_SIZE = 32
+
+# number of 160x160 crops stacked into one facenet forward pass, lower it to save memory
+EMBED_BATCH_SIZE = 64
+
+# background threads decoding PNGs and the max number of decoded images held in memory
+DECODE_THREADS = 4
+PREFETCH_IMAGES = 256
+
+# trial rows read, scored and written per step when streaming results
+TRIAL_CHUNK_SIZE = 4096
+
+# trial columns that reference a stimulus image
+IMAGE_COLUMNS = ['encoding_image', 'target_image', 'innocent_image', 'left_image', 'right_image']
+RESULT_COLUMNS = ['trial', 'predicted', 'correct_position', 'accuracy', 'dist_left', 'dist_right', 'margin']
+
+# models and the cache are process-wide singletons created on first use, so importing
+# this module does no weight loading or file I/O
+_facenet = None
+_mtcnn = {}
+_embedding_cache = None
+_crop_cache = None
+_failure_registry = None
+# packed stimulus bundle per image directory (None where none is built), see stimulus_bundle.py
+_bundles = {}
+# worker processes only read the shared crop cache, the parent writes what they detect
+_read_only_caches = False
+# per-stage timing is off unless enable_profiling() is called, and then costs one timer per batch
+_profiler = None
+_NO_STAGE = nullcontext()
+
+def default_trials_path(image_root=None):
+    # eyewitness_trials.csv in the image root, or else the one next to the code
+    trials_path = os.path.join(image_root or FILE_PATH, 'eyewitness_trials.csv')
+    return trials_path if os.path.exists(trials_path) else os.path.join(CODE_DIR, 'eyewitness_trials.csv')
+
+def facenet_weights_path(slim=None):
+    return FACENET_SLIM_WEIGHTS_PATH if (FACENET_SLIM if slim is None else slim) else FACENET_WEIGHTS_PATH
+
+def save_facenet_weights():
+    # download the vggface2 weights once, keeping the full state_dict and a copy without the classifier
+    if not os.path.exists(FACENET_WEIGHTS_PATH):
+        from facenet_pytorch import InceptionResnetV1
+        model = InceptionResnetV1(pretrained=FACENET_WEIGHTS)
+        os.makedirs(os.path.dirname(FACENET_WEIGHTS_PATH), exist_ok=True)
+        # renamed into place once complete, an interrupted or concurrent save must not leave a truncated file behind
+        with replacing(FACENET_WEIGHTS_PATH) as tmp_path:
+            torch.save(model.state_dict(), tmp_path)
+    if not os.path.exists(FACENET_SLIM_WEIGHTS_PATH):
+        state_dict = torch.load(FACENET_WEIGHTS_PATH, map_location='cpu', mmap=True, weights_only=True)
+        with replacing(FACENET_SLIM_WEIGHTS_PATH) as tmp_path:
+            torch.save({name: tensor for name, tensor in state_dict.items() if not name.startswith('logits.')}, tmp_path)
+
+def load_facenet(slim=None):
+    # float32 facenet, a fresh instance on every call
+    from facenet_pytorch import InceptionResnetV1
+    slim = FACENET_SLIM if slim is None else slim
+    weights_path = facenet_weights_path(slim)
+    if not os.path.exists(weights_path):
+        save_facenet_weights()
+
+    # build the module without allocating parameters, then adopt the
+    # memory-mapped tensors directly instead of copying them in
+    with torch.device('meta'):
+        model = InceptionResnetV1(classify=False)
+        if not slim:
+            model.logits = torch.nn.Linear(512, 8631)
+    state_dict = torch.load(weights_path, map_location='cpu', mmap=True, weights_only=True)
+    model.load_state_dict(state_dict, assign=True)
+    return model.eval().to(device)
+
+def facenet_weights_hash():
+    # content hash of the weight file facenet loads, part of the embedding cache key so replacing the
+    # weights invalidates embeddings made with the old ones; a sidecar keyed on size and mtime saves
+    # re-hashing the file on every run
+    weights_path = facenet_weights_path()
+    if not os.path.exists(weights_path):
+        save_facenet_weights()
+    stat = os.stat(weights_path)
+    sidecar_path = weights_path + '.sha256.json'
+    entry = read_json(sidecar_path, {})
+    if entry.get('size') != stat.st_size or entry.get('mtime_ns') != stat.st_mtime_ns:
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': file_hash(weights_path)}
+        write_json(sidecar_path, entry)
+    return entry['hash']
+
+def torchscript_path():
+    # the traced artefact is only valid for these weights, this torch build, device and batch shape
+    stat = os.stat(facenet_weights_path())
+    key = config_hash({'weights': facenet_weights_path(), 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                       'torch': torch.__version__, 'device': str(device), 'batch_size': EMBED_BATCH_SIZE})
+    return os.path.join(WEIGHTS_DIR, f'facenet-torchscript-{key}.pt')
+
+def facenet_precision(model_device, precision=None):
+    # autocast context facenet runs under, a no-op at float32
+    precision = precision or FACENET_PRECISION
+    if precision not in FACENET_PRECISIONS:
+        raise ValueError(f"Unknown facenet precision {precision!r}, expected one of {FACENET_PRECISIONS}")
+    return torch.autocast(model_device.type, dtype=getattr(torch, precision), enabled=precision != 'float32')
+
+def build_facenet(backend=None, precision=None):
+    backend = backend or FACENET_BACKEND
+    if backend not in FACENET_BACKENDS:
+        raise ValueError(f"Unknown facenet backend {backend!r}, expected one of {FACENET_BACKENDS}")
+    if backend == 'torchscript':
+        if not os.path.exists(facenet_weights_path()):
+            save_facenet_weights()
+        model = trace_facenet(load_facenet, EMBED_BATCH_SIZE, torchscript_path(), device)
+    elif backend == 'compiled':
+        model = compile_facenet(load_facenet(), EMBED_BATCH_SIZE, os.path.join(WEIGHTS_DIR, 'inductor_cache'), device)
+    else:
+        model = load_facenet()
+        if backend == 'int8':
+            model = quantize_int8(model, get_calibration_crops())
+        return model
+    # compiled graphs are specialised on the autocast state, so warm up in the precision used later
+    with facenet_precision(device, precision):
+        warm_up(model, EMBED_BATCH_SIZE, device)
+    return model
+
+def get_facenet():
+    global _facenet
+    if _facenet is None:
+        with stage('load_facenet'):
+            _facenet = build_facenet()
+    return _facenet
+
+def model_device(model):
+    # quantised models keep their weights packed outside .parameters() and always run on the CPU,
+    # frozen traced models have no parameters at all and record their device on the wrapper
+    if hasattr(model, 'input_device'):
+        return model.input_device
+    parameter = next(model.parameters(), None)
+    return parameter.device if parameter is not None else torch.device('cpu')
+
+def get_calibration_crops():
+    # face crops of the stimulus PNGs in FILE_PATH, detected once and saved next to the weights
+    if os.path.exists(CALIBRATION_PATH):
+        return torch.load(CALIBRATION_PATH, weights_only=True)
+    image_paths = sorted(glob.glob(os.path.join(FILE_PATH, '*.png')))
+    crops, _ = detect_faces([load_image(image_path) for image_path in image_paths])
+    crops = [crop for crop in crops if crop is not None]
+    if not crops:
+        raise ValueError(f"No faces detected in {FILE_PATH} to calibrate the int8 model on")
+    crops = torch.stack(crops)
+    os.makedirs(os.path.dirname(CALIBRATION_PATH), exist_ok=True)
+    torch.save(crops, CALIBRATION_PATH)
+    return crops
 
-FILE_PATH = '/Users/codylejang/Desktop/eyewitness/'
+def get_mtcnn(tier=0):
+    # one detector per tier of DETECTION_TIERS, built the first time that tier is needed
+    if tier not in _mtcnn:
+        from facenet_pytorch import MTCNN
+        settings = {**MTCNN_SETTINGS, **DETECTION_TIERS[tier]}
+        settings.pop('upscale', None)
+        with stage('load_mtcnn'):
+            _mtcnn[tier] = MTCNN(**settings)
+    return _mtcnn[tier]
+
+def detector_config():
+    # everything a face crop depends on, part of both the crop and the embedding cache keys
+    config = {'mtcnn': MTCNN_SETTINGS}
+    if len(DETECTION_TIERS) > 1:
+        config['retry_tiers'] = DETECTION_TIERS[1:]
+    return config
+
+def enable_profiling(trace_memory=False):
+    # start recording decode / mtcnn / facenet / scoring stages, see stage_profiler.py
+    global _profiler
+    _profiler = StageProfiler(trace_memory)
+    return _profiler
+
+def disable_profiling():
+    # stop recording and return the summary of what was recorded
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler.summary() if profiler is not None else None
+
+def stage(name, items=1):
+    return _NO_STAGE if _profiler is None else _profiler.stage(name, items)
+
+def count(name, n=1):
+    if _profiler is not None:
+        _profiler.count(name, n)
+
+def embedding_config():
+    # everything an embedding depends on, the embedding cache key
+    config = {**detector_config(), 'facenet': FACENET_WEIGHTS, 'weights': facenet_weights_hash()[:16]}
+    if FACENET_BACKEND != 'eager':
+        config['backend'] = FACENET_BACKEND
+    if FACENET_PRECISION != 'float32':
+        config['precision'] = FACENET_PRECISION
+    return config
+
+def get_embedding_cache():
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache(CACHE_DIR, embedding_config())
+        atexit.register(_embedding_cache.flush)
+    return _embedding_cache
+
+def get_crop_cache():
+    # face crops depend only on the detector settings, so every facenet backend shares them
+    global _crop_cache
+    if _crop_cache is None:
+        _crop_cache = CropCache(os.path.join(CACHE_DIR, 'crops'), detector_config(),
+                                MTCNN_SETTINGS['image_size'], read_only=_read_only_caches)
+        atexit.register(_crop_cache.flush)
+    return _crop_cache
+
+def get_failure_registry():
+    global _failure_registry
+    if _failure_registry is None:
+        _failure_registry = FailureRegistry(os.path.join(CACHE_DIR, 'failures'), detector_config(),
+                                            read_only=_read_only_caches)
+        atexit.register(_failure_registry.flush)
+    return _failure_registry
+
+def failure_report(trials_path=None, image_root=None):
+    # which stimuli of a trial table are registered detection failures, and how many trials each costs
+    image_root = image_root or FILE_PATH
+    loadouts = pd.read_csv(trials_path or default_trials_path(image_root))
+    registry = get_failure_registry()
+    images = loadouts[IMAGE_COLUMNS]
+    rows = []
+    for name in pd.unique(images.values.ravel()):
+        key = image_hash(os.path.join(image_root, name))
+        if key in registry:
+            rows.append({'image': name, 'hash': key, 'recorded': registry.get(key)['recorded'],
+                         'trials_lost': int(images.eq(name).any(axis=1).sum())})
+    return pd.DataFrame(rows, columns=['image', 'hash', 'recorded', 'trials_lost'])
+
+def encode_crop(crop):
+    # undo mtcnn's fixed standardisation, recovering the exact uint8 pixels it resized
+    pixels = crop * 128 + 127.5 if MTCNN_SETTINGS['post_process'] else crop
+    return pixels.round().clamp(0, 255).to(torch.uint8).numpy()
+
+def detection_tier(image_path):
+    # the DETECTION_TIERS index that found the face in this image, None if it has no cached face
+    return get_crop_cache().tier(image_hash(image_path))
+
+def decode_crop(pixels):
+    crop = torch.from_numpy(pixels).float()
+    return (crop - 127.5) / 128 if MTCNN_SETTINGS['post_process'] else crop
 
 # # example image to output
 # image_path = '/Users/codylejang/Desktop/eyewitness/innocent13.png'
 # output_path = '/Users/codylejang/Desktop/face_crop_example.png'
 
+# import torchvision.transforms as transforms
+
 # # load image
 # img = Image.open(image_path).convert('RGB')
 
@@ -33,68 +332,556 @@ FILE_PATH = '/Users/codylejang/Desktop/eyewitness/'
 # face_pil.save('/Users/codylejang/Desktop/face_crop_example.png')
 
 def get_embedding(image_path):
-    #image preprocessing for facenet
-    img = Image.open(image_path).convert('RGB')
-    face_tensor = mtcnn(img)
-    if face_tensor is None:
-        print(f"Face not detected in {image_path}")
-        return None
-    
-    with torch.no_grad():
-        face = face_tensor.unsqueeze(0).to(device)
-    embedding = facenet(face)
-
-    return embedding.detach().cpu().numpy()[0]
-
-def run_trials():
-    # path to master csv with all trials
-    all_trials_path = os.path.join(FILE_PATH, 'eyewitness_trials.csv')
-    loadouts = pd.read_csv(all_trials_path)
-    
-    error_log = []
+    # single-image form of embed_images(), with the same caching and failure message
+    return embed_images([image_path])[image_path]
+
+def get_stimulus_bundle(image_dir):
+    if image_dir not in _bundles:
+        _bundles[image_dir] = open_bundle(image_dir)
+    return _bundles[image_dir]
+
+def image_hash(image_path):
+    # file_hash() of the image, taken from the stimulus bundle's index when the png is bundled
+    bundle = get_stimulus_bundle(os.path.dirname(image_path))
+    key = bundle.hash(os.path.basename(image_path)) if bundle is not None else None
+    return key or file_hash(image_path)
+
+def load_image(image_path):
+    # bundled stimuli are a slice of the memory-mapped bundle, everything else is opened and decoded
+    bundle = get_stimulus_bundle(os.path.dirname(image_path))
+    if bundle is not None:
+        with stage('bundle'):
+            img = bundle.pil_image(os.path.basename(image_path))
+            if img is not None:
+                return img.convert('RGB')
+    with stage('decode'):
+        return Image.open(image_path).convert('RGB')
+
+def prefetch_images(image_paths, num_threads=DECODE_THREADS, prefetch=PREFETCH_IMAGES):
+    # decode images on a thread pool ahead of the consumer, in input order; the queue of
+    # in-flight images is capped at `prefetch` so memory stays bounded for any gallery size
+    pool = ThreadPoolExecutor(max_workers=num_threads)
+    queue = deque()
+    try:
+        for image_path in image_paths:
+            queue.append(pool.submit(load_image, image_path))
+            if len(queue) >= prefetch:
+                yield queue.popleft().result()
+        while queue:
+            yield queue.popleft().result()
+    finally:
+        for future in queue:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+def embed_faces(crops, batch_size=EMBED_BATCH_SIZE, model=None, precision=None):
+    # stack detected crops into batches and run facenet without building an autograd graph
+    facenet = model or get_facenet()
+    facenet_device = model_device(facenet)
+    embeddings = np.empty((len(crops), 512), dtype=np.float32)
+    with torch.inference_mode(), facenet_precision(facenet_device, precision):
+        for start in range(0, len(crops), batch_size):
+            batch = crops[start:start + batch_size]
+            with stage('facenet', len(batch)):
+                faces = torch.stack(batch).to(facenet_device)
+                embeddings[start:start + len(faces)] = facenet(faces).float().cpu().numpy()
+    return embeddings
+
+def detect_faces(images, batch_size=DETECT_BATCH_SIZE, tier=0):
+    # mtcnn only batches images of equal size, so group by size and run the cascade
+    # once per chunk; returns one crop (or None) per input image and the failed indices
+    mtcnn = get_mtcnn(tier)
+    crops = [None] * len(images)
+    by_size = {}
+    for i, img in enumerate(images):
+        by_size.setdefault(img.size, []).append(i)
+
+    for indices in by_size.values():
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+            with stage('mtcnn' if tier == 0 else f'mtcnn_tier_{tier}', len(chunk)):
+                faces = mtcnn([images[i] for i in chunk])
+            for i, face in zip(chunk, faces):
+                crops[i] = face
+
+    failures = [i for i, crop in enumerate(crops) if crop is None]
+    return crops, failures
+
+def detect_faces_tiered(images, batch_size=DETECT_BATCH_SIZE):
+    # walk the DETECTION_TIERS ladder, each tier only sees the images no earlier tier found a face in;
+    # returns one crop (or None) per image and the tier that found it (or None)
+    crops = [None] * len(images)
+    tiers = [None] * len(images)
+    remaining = list(range(len(images)))
+    for tier, settings in enumerate(DETECTION_TIERS):
+        if not remaining:
+            break
+        upscale = settings.get('upscale', 1)
+        batch = [images[i] for i in remaining]
+        if upscale != 1:
+            batch = [img.resize((img.width * upscale, img.height * upscale), Image.BICUBIC) for img in batch]
+        found, failures = detect_faces(batch, batch_size, tier)
+        count(f'tier_{tier}_detections', len(batch) - len(failures))
+        for i, crop in zip(remaining, found):
+            if crop is not None:
+                crops[i] = crop
+                tiers[i] = tier
+        remaining = [remaining[j] for j in failures]
+
+    count('detections', len(images) - len(remaining))
+    count('failures', len(remaining))
+    return crops, tiers
+
+def detect_and_embed(image_paths, keys, batch_size=EMBED_BATCH_SIZE, num_threads=DECODE_THREADS,
+                     prefetch=PREFETCH_IMAGES):
+    # uncached pipeline: images are decoded on background threads while the main thread detects
+    # and embeds them one bounded chunk at a time, so decode and inference overlap; images whose
+    # crop is already cached skip decoding and mtcnn and go straight to facenet
+    # returns one embedding and detection tier (both None when no face was found) per path, in order;
+    # new crops go straight into the crop cache, or are returned as (key, uint8 pixels, tier) when it is read-only
+    crop_cache = get_crop_cache()
+    cached = [key in crop_cache for key in keys]
+    count('crop_cache_hits', sum(cached))
+    images = prefetch_images([path for path, hit in zip(image_paths, cached) if not hit], num_threads, prefetch)
     results = []
-    for i, trial in loadouts.iterrows():
-        # get embeddings from paths to all images
-        encoding_image = get_embedding(os.path.join(FILE_PATH, trial.loc['encoding_image']))
-        target_image = get_embedding(os.path.join(FILE_PATH, trial.loc['target_image']))
-        innocent_image = get_embedding(os.path.join(FILE_PATH, trial.loc['innocent_image']))
-        left_image = get_embedding(os.path.join(FILE_PATH, trial.loc['left_image']))
-        right_image = get_embedding(os.path.join(FILE_PATH, trial.loc['right_image']))
-        correct_position = trial['correct_position'].strip().lower()
-        
-        #logging undetected faces or errors
-        if any(x is None for x in [encoding_image, target_image, innocent_image]):
-            for image_name, image in zip(['encoding', 'target', 'innocent'], [encoding_image, target_image, innocent_image]):
-                if image is None:
-                    error_log.append(f"{i} - {image_name} face not detected")
+    tiers = []
+    new_crops = []
+    for start in range(0, len(image_paths), prefetch):
+        chunk = range(start, min(start + prefetch, len(image_paths)))
+        missing = [i for i in chunk if not cached[i]]
+        detected, detected_tiers = detect_faces_tiered([next(images) for _ in missing])
+        crops = dict(zip(missing, detected))
+        chunk_tiers = dict(zip(missing, detected_tiers))
+        for i in chunk:
+            if cached[i]:
+                crops[i] = decode_crop(crop_cache.get(keys[i]))
+                chunk_tiers[i] = crop_cache.tier(keys[i])
+            elif crops[i] is not None and crop_cache.read_only:
+                new_crops.append((keys[i], encode_crop(crops[i]), chunk_tiers[i]))
+            elif crops[i] is not None:
+                crop_cache.put(keys[i], encode_crop(crops[i]), chunk_tiers[i])
+        tiers.extend(chunk_tiers[i] for i in chunk)
+
+        chunk_results = [None] * len(chunk)
+        found = [i for i in chunk if crops[i] is not None]
+        for i, embedding in zip(found, embed_faces([crops[i] for i in found], batch_size)):
+            chunk_results[i - start] = embedding
+        results.extend(chunk_results)
+    images.close()
+    return results, tiers, new_crops
+
+# module settings a spawned worker needs to match the parent process
+WORKER_SETTINGS = ['FILE_PATH', 'CACHE_DIR', 'WEIGHTS_DIR', 'FACENET_WEIGHTS', 'FACENET_WEIGHTS_PATH',
+                   'FACENET_SLIM_WEIGHTS_PATH', 'FACENET_SLIM', 'FACENET_BACKEND',
+                   'FACENET_PRECISION', 'CALIBRATION_PATH', 'MTCNN_SETTINGS', 'DETECTION_TIERS', 'DETECT_BATCH_SIZE', 'EMBED_BATCH_SIZE']
+
+def _init_worker(settings, torch_threads, trace_memory):
+    globals().update(settings, _read_only_caches=True)
+    if trace_memory is not None:
+        enable_profiling(trace_memory)
+    torch.set_num_threads(torch_threads)
+
+def _embed_shard(image_paths, keys, batch_size, num_threads, prefetch):
+    start = time.perf_counter()
+    get_facenet()
+    loaded = time.perf_counter()
+    embeddings, tiers, new_crops = detect_and_embed(image_paths, keys, batch_size, num_threads, prefetch)
+    records = _profiler.records() if _profiler is not None else None
+    return embeddings, tiers, new_crops, records, loaded - start, time.perf_counter() - loaded
+
+def embed_sharded(image_paths, keys, workers, batch_size=EMBED_BATCH_SIZE, num_threads=DECODE_THREADS,
+                  prefetch=PREFETCH_IMAGES):
+    # split the images into one contiguous shard per worker process, each with its own models and
+    # a pinned share of the cores, then merge the shards back in input order
+    image_paths = list(image_paths)
+    workers = max(1, min(workers, len(image_paths)))
+    bounds = [len(image_paths) * w // workers for w in range(workers + 1)]
+    shards = [(image_paths[bounds[w]:bounds[w + 1]], keys[bounds[w]:bounds[w + 1]]) for w in range(workers)]
+    torch_threads = max(1, torch.get_num_threads() // workers)
+
+    # write the local weight file and calibration crops once here rather than racing in every worker
+    if not os.path.exists(facenet_weights_path()):
+        save_facenet_weights()
+    if FACENET_BACKEND == 'int8' and not os.path.exists(CALIBRATION_PATH):
+        get_calibration_crops()
+
+    # spawn rather than fork, forking after torch has started its thread pools can deadlock
+    settings = {name: globals()[name] for name in WORKER_SETTINGS}
+    trace_memory = _profiler.trace_memory if _profiler is not None else None
+    results = []
+    tiers = []
+    new_crops = []
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(settings, torch_threads, trace_memory)) as pool:
+        futures = [pool.submit(_embed_shard, *shard, batch_size, num_threads, prefetch) for shard in shards]
+        for worker, future in enumerate(futures):
+            embeddings, shard_tiers, shard_crops, records, load_time, run_time = future.result()
+            if records is not None:
+                _profiler.merge(records)
+            print(f"worker {worker}: {len(embeddings)} images in {run_time:.2f}s "
+                  f"({len(embeddings) / run_time:.1f} images/sec, model load {load_time:.2f}s)", file=sys.stderr)
+            results.extend(embeddings)
+            tiers.extend(shard_tiers)
+            new_crops.extend(shard_crops)
+    return results, tiers, new_crops
+
+def embed_images(image_paths, batch_size=EMBED_BATCH_SIZE, num_threads=DECODE_THREADS,
+                 prefetch=PREFETCH_IMAGES, workers=1):
+    # embed every unique image exactly once, failed detections map to None; images that failed
+    # detection on an earlier run with the same detector settings are not tried again
+    embedding_cache = get_embedding_cache()
+    failure_registry = get_failure_registry()
+    embeddings = {}
+    pending = []
+    known_failures = 0
+    for image_path in dict.fromkeys(image_paths):
+        key = image_hash(image_path)
+        embeddings[image_path] = embedding_cache.get(key)
+        if embeddings[image_path] is not None:
+            continue
+        if key in failure_registry:
+            known_failures += 1
+        else:
+            pending.append((image_path, key))
+    count('images', len(embeddings))
+    count('embedding_cache_hits', len(embeddings) - len(pending) - known_failures)
+    count('known_failures', known_failures)
+    if known_failures:
+        print(f"Skipped {known_failures} images with no face found on an earlier run (see --failures)", file=sys.stderr)
+
+    pending_paths = [image_path for image_path, _ in pending]
+    pending_keys = [key for _, key in pending]
+    if workers > 1 and len(pending) > 1:
+        vectors, tiers, new_crops = embed_sharded(pending_paths, pending_keys, workers, batch_size, num_threads, prefetch)
+    else:
+        vectors, tiers, new_crops = detect_and_embed(pending_paths, pending_keys, batch_size, num_threads, prefetch)
+
+    crop_cache = get_crop_cache()
+    for key, pixels, tier in new_crops:
+        crop_cache.put(key, pixels, tier)
+    crop_cache.flush()
+
+    # failures and retried detections are reported and results cached in input order,
+    # however the work was split
+    for (image_path, key), embedding, tier in zip(pending, vectors, tiers):
+        if embedding is None:
+            print(f"Face not detected in {image_path}")
+            failure_registry.add(key, image_path)
             continue
-        
-        # compute distances 
-        dist_left = np.linalg.norm(encoding_image - left_image)
-        dist_right = np.linalg.norm(encoding_image - right_image)
-        predicted = 'left' if dist_left < dist_right else 'right'
-        correct = (predicted == correct_position)
-        
-        results.append({
-            'trial': i,
-            'predicted': predicted,
-            'correct_position': correct_position,
-            'accuracy': int(correct),
-            'dist_left': dist_left,
-            'dist_right': dist_right
-        })
-    
-    return pd.DataFrame(results), error_log
+        if tier:
+            print(f"Face detected in {image_path} at retry tier {tier}", file=sys.stderr)
+        embedding_cache.put(key, embedding)
+        embeddings[image_path] = embedding
+
+    embedding_cache.flush()
+    failure_registry.flush()
+    return embeddings
+
+def face_crops(image_paths, keys=None):
+    # uint8 face crop per image (None when no face is found), from the crop cache where possible;
+    # the rest are decoded and detected down the retry ladder, and their crops or failures recorded
+    keys = keys or [image_hash(image_path) for image_path in image_paths]
+    crop_cache = get_crop_cache()
+    failure_registry = get_failure_registry()
+    crops = {}
+    missing = []
+    for image_path, key in zip(image_paths, keys):
+        crops[image_path] = crop_cache.get(key)
+        if crops[image_path] is None and key not in failure_registry:
+            missing.append((image_path, key))
+
+    images = prefetch_images([image_path for image_path, _ in missing])
+    for start in range(0, len(missing), PREFETCH_IMAGES):
+        chunk = missing[start:start + PREFETCH_IMAGES]
+        detected, tiers = detect_faces_tiered([next(images) for _ in chunk])
+        for (image_path, key), crop, tier in zip(chunk, detected, tiers):
+            if crop is None:
+                print(f"Face not detected in {image_path}")
+                failure_registry.add(key, image_path)
+                continue
+            crops[image_path] = encode_crop(crop)
+            crop_cache.put(key, crops[image_path], tier)
+    crop_cache.flush()
+    failure_registry.flush()
+    return crops
+
+def embedding_matrix(image_names, embeddings, image_root=None):
+    # stack the detected embeddings into an (n_images, 512) matrix and map each image name to its row
+    image_root = image_root or FILE_PATH
+    rows = {}
+    vectors = []
+    for name in image_names:
+        embedding = embeddings[os.path.join(image_root, name)]
+        if embedding is not None:
+            rows[name] = len(vectors)
+            vectors.append(embedding)
+    matrix = np.stack(vectors) if vectors else np.empty((0, 512), dtype=np.float32)
+    return matrix, rows
+
+def missing_faces(loadouts, rows):
+    # {'encoding': mask, ..., 'right': mask} of the trials whose image in that column has no face. left
+    # and right are only reported when they are not the row's target or innocent image, which is
+    # reported already, so every trial with a missing face gets at least one entry and none twice
+    missing = {column[:-len('_image')]: ~loadouts[column].isin(rows).to_numpy() for column in IMAGE_COLUMNS}
+    for name in ['left', 'right']:
+        shown = loadouts[f'{name}_image'].to_numpy()
+        missing[name] &= (shown != loadouts['target_image'].to_numpy()) & (shown != loadouts['innocent_image'].to_numpy())
+    return missing
+
+def score_loadouts(loadouts, matrix, rows, metric='euclidean'):
+    # map every trial image to its embedding row, undetected faces become NaN
+    index = {column: loadouts[column].map(rows) for column in IMAGE_COLUMNS}
+
+    #logging undetected faces or errors
+    error_log = []
+    missing = missing_faces(loadouts, rows)
+    for i in np.flatnonzero(np.logical_or.reduce(list(missing.values()))):
+        for image_name in missing:
+            if missing[image_name][i]:
+                error_log.append(f"{loadouts.index[i]} - {image_name} face not detected")
+
+    valid = np.logical_and.reduce([index[column].notna().to_numpy() for column in IMAGE_COLUMNS])
+    trials = loadouts[valid]
+    correct_position = trials['correct_position'].str.strip().str.lower().to_numpy()
+
+    # compute distances for all valid trials at once
+    with stage('scoring', len(trials)):
+        scores = score_trials(
+            matrix,
+            index['encoding_image'][valid].to_numpy(dtype=int),
+            index['left_image'][valid].to_numpy(dtype=int),
+            index['right_image'][valid].to_numpy(dtype=int),
+            correct_position == 'left',
+            metric
+        )
+
+    results = pd.DataFrame({
+        'trial': trials.index,
+        'predicted': np.where(scores['predicted_left'], 'left', 'right'),
+        'correct_position': correct_position,
+        'accuracy': scores['accuracy'],
+        'dist_left': scores['dist_left'],
+        'dist_right': scores['dist_right'],
+        'margin': scores['margin']
+    })
+    return results, error_log
+
+def run_trials(metric='euclidean', trials_path=None, image_root=None, profile=False, trace_memory=False):
+    # profile=True prints a json summary of per-stage timings and counts once the trials are scored,
+    # trace_memory adds tracemalloc peaks per stage at some cost in speed
+    if profile:
+        enable_profiling(trace_memory)
+    image_root = image_root or FILE_PATH
+    # path to master csv with all trials
+    all_trials_path = trials_path or default_trials_path(image_root)
+    loadouts = pd.read_csv(all_trials_path)
+
+    # left/right always repeat target/innocent and foils are reused across lineups,
+    # so embed the unique images once up front and score trials from the lookup
+    unique_images = pd.unique(loadouts[IMAGE_COLUMNS].values.ravel())
+    embeddings = embed_images([os.path.join(image_root, name) for name in unique_images])
+
+    matrix, rows = embedding_matrix(unique_images, embeddings, image_root)
+    results = score_loadouts(loadouts, matrix, rows, metric)
+    if profile:
+        print(json.dumps(disable_profiling(), indent=2))
+    return results
+
+def run_trials_incremental(metric='euclidean', trials_path=None, image_root=None, manifest_dir=None,
+                           batch_size=EMBED_BATCH_SIZE, num_threads=DECODE_THREADS, workers=1):
+    # run_trials() that only embeds and scores the trial rows that are new, edited or show a replaced
+    # image since the last run, taking every other row's outcome from the manifest (see run_manifest.py);
+    # returns (results, error_log, n_rescored)
+    image_root = image_root or FILE_PATH
+    manifest_dir = manifest_dir or os.path.join(CACHE_DIR, 'manifest')
+    loadouts = pd.read_csv(trials_path or default_trials_path(image_root))
+    config = {**embedding_config(), 'backend': FACENET_BACKEND, 'precision': FACENET_PRECISION, 'metric': metric}
+    previous_images, previous_rows = load_manifest(manifest_dir, config)
+    images = hash_images(pd.unique(loadouts[IMAGE_COLUMNS].values.ravel()), image_root, previous_images)
+    keys = row_keys(loadouts, images, IMAGE_COLUMNS)
+    known = keys.isin(previous_rows.index).to_numpy()
+
+    rows = pd.DataFrame({column: pd.Series(dtype=previous_rows[column].dtype) for column in ROW_COLUMNS},
+                        index=loadouts.index)
+    rows.loc[known] = previous_rows.loc[keys[known]].to_numpy()
+    changed = loadouts[~known]
+    if len(changed):
+        names = pd.unique(changed[IMAGE_COLUMNS].values.ravel())
+        embeddings = embed_images([os.path.join(image_root, name) for name in names], batch_size, num_threads,
+                                  workers=workers)
+        matrix, image_rows = embedding_matrix(names, embeddings, image_root)
+        results, _ = score_loadouts(changed, matrix, image_rows, metric)
+        missing = missing_faces(changed, image_rows)
+        rows.loc[~known, 'errors'] = [';'.join(name for name in missing if missing[name][i]) for i in range(len(changed))]
+        rows.loc[results['trial'], ROW_COLUMNS[:-1]] = results[ROW_COLUMNS[:-1]].to_numpy()
+    save_manifest(manifest_dir, config, images, rows.set_index(keys.to_numpy()))
+
+    # same rows, order and error messages as score_loadouts() over the whole table
+    scored = (rows['errors'] == '').to_numpy()
+    results = pd.DataFrame({
+        'trial': loadouts.index[scored],
+        'predicted': rows['predicted'][scored].to_numpy(),
+        'correct_position': loadouts['correct_position'].str.strip().str.lower()[scored].to_numpy(),
+        'accuracy': rows['accuracy'][scored].to_numpy(dtype=int),
+        'dist_left': rows['dist_left'][scored].to_numpy(dtype=float),
+        'dist_right': rows['dist_right'][scored].to_numpy(dtype=float),
+        'margin': rows['margin'][scored].to_numpy(dtype=float)
+    })
+    error_log = [f"{i} - {name} face not detected" for i, errors in rows['errors'].items() if errors
+                 for name in errors.split(';')]
+    return results, error_log, int((~known).sum())
+
+def iter_trial_results(trial_chunks, image_root=None, metric='euclidean',
+                       batch_size=EMBED_BATCH_SIZE, num_threads=DECODE_THREADS, workers=1):
+    # score an iterable of trial-table chunks, yielding (results, error_log) as soon as each
+    # chunk's images are embedded; embeddings carry over so each image is embedded once,
+    # while trials and results never accumulate in memory
+    image_root = image_root or FILE_PATH
+    embeddings = {}
+    for chunk in trial_chunks:
+        names = pd.unique(chunk[IMAGE_COLUMNS].values.ravel())
+        new_paths = [os.path.join(image_root, name) for name in names
+                     if os.path.join(image_root, name) not in embeddings]
+        if new_paths:
+            embeddings.update(embed_images(new_paths, batch_size, num_threads, workers=workers))
+        matrix, rows = embedding_matrix(names, embeddings, image_root)
+        yield score_loadouts(chunk, matrix, rows, metric)
+
+def stream_trials(trials_path=None, image_root=None, metric='euclidean', chunk_size=TRIAL_CHUNK_SIZE,
+                  batch_size=EMBED_BATCH_SIZE, num_threads=DECODE_THREADS, workers=1):
+    # read the trial csv lazily, chunk_size rows at a time; the row index (and so the
+    # trial number in results and errors) keeps counting across chunks
+    image_root = image_root or FILE_PATH
+    trials_path = trials_path or default_trials_path(image_root)
+    with pd.read_csv(trials_path, chunksize=chunk_size) as reader:
+        yield from iter_trial_results(reader, image_root, metric, batch_size, num_threads, workers)
+
+def run_lineups(n_alternatives=6, n_lineups=1000, metric='euclidean', seed=0, trials_path=None, image_root=None):
+    # simulate n-person lineups: each shows one culprit's target photo among n-1 foils drawn
+    # from the innocent images, scored against the culprit's encoding image
+    image_root = image_root or FILE_PATH
+    all_trials_path = trials_path or default_trials_path(image_root)
+    loadouts = pd.read_csv(all_trials_path)
+    unique_images = pd.unique(loadouts[IMAGE_COLUMNS].values.ravel())
+    embeddings = embed_images([os.path.join(image_root, name) for name in unique_images])
+    matrix, rows = embedding_matrix(unique_images, embeddings, image_root)
+
+    # one embedding pass and one distance matrix serve every lineup configuration
+    distances = cached_distance_matrix(matrix, os.path.join(CACHE_DIR, 'distances'), metric)
+
+    culprits = loadouts[loadouts['encoding_image'].isin(rows) & loadouts['target_image'].isin(rows)]
+    foil_pool = np.array([rows[name] for name in pd.unique(loadouts['innocent_image']) if name in rows])
+    if len(foil_pool) < n_alternatives - 1:
+        raise ValueError(f"{n_alternatives}-person lineups need {n_alternatives - 1} foils, "
+                         f"only {len(foil_pool)} innocent faces were detected")
+
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(len(culprits), size=n_lineups)
+    encoding_idx = culprits['encoding_image'].map(rows).to_numpy()[picks]
+    target_idx = culprits['target_image'].map(rows).to_numpy()[picks]
+
+    # distinct foils per lineup, with the culprit placed at a random position
+    foils = foil_pool[rng.random((n_lineups, len(foil_pool))).argsort(axis=1)[:, :n_alternatives - 1]]
+    target_pos = rng.integers(n_alternatives, size=n_lineups)
+    is_target = np.arange(n_alternatives)[None, :] == target_pos[:, None]
+    lineup_idx = np.empty((n_lineups, n_alternatives), dtype=int)
+    lineup_idx[is_target] = target_idx
+    lineup_idx[~is_target] = foils.ravel()
+
+    scores = score_lineups(distances, encoding_idx, lineup_idx, target_pos)
+    return pd.DataFrame({
+        'trial': culprits.index[picks],
+        'target_position': target_pos,
+        'chosen_position': scores['chosen'],
+        'accuracy': scores['accuracy'],
+        'margin': scores['margin']
+    })
 
-results_df, errors = run_trials()
-print(results_df)
-print(f"\nErrors: {len(errors)}")
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the FaceNet machine witness over a table of 2AFC trials.')
+    parser.add_argument('--trials', help='trial CSV (default: <image-root>/eyewitness_trials.csv, else the one next to the code)')
+    parser.add_argument('--image-root', default=FILE_PATH, help='directory the image names in the trial CSV are relative to')
+    parser.add_argument('--output', default='machine_results.csv', help='results CSV, written as trials are scored')
+    parser.add_argument('--errors', help='error log, one line per undetected face (default: <output>.errors.txt)')
+    parser.add_argument('--cache-dir', help='embedding cache directory (default: <image-root>/embedding_cache)')
+    parser.add_argument('--batch-size', type=int, default=EMBED_BATCH_SIZE, help='face crops per facenet forward pass')
+    parser.add_argument('--threads', type=int, help='torch intra-op threads (default: torch default, split across --workers)')
+    parser.add_argument('--workers', type=int, default=1, help='processes embedding shards of the images in parallel')
+    parser.add_argument('--decode-threads', type=int, default=DECODE_THREADS, help='threads decoding images ahead of inference')
+    parser.add_argument('--chunk-size', type=int, default=TRIAL_CHUNK_SIZE, help='trial rows read, scored and written per step')
+    parser.add_argument('--metric', choices=METRICS, default='euclidean')
+    parser.add_argument('--backend', choices=FACENET_BACKENDS, default=FACENET_BACKEND,
+                        help='how facenet runs: int8 is quantised, torchscript and compiled are traced/compiled '
+                             'once for --batch-size and cached in weights/ (see compare_backends.py)')
+    parser.add_argument('--no-retry', action='store_true',
+                        help='detect with MTCNN_SETTINGS only, without the DETECTION_TIERS retry ladder')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only re-embed and re-score trials whose row or images changed since the last '
+                             '--incremental run, merging with its results (manifest under the cache dir)')
+    parser.add_argument('--failures', action='store_true',
+                        help='print the images of --trials registered as detection failures and the trials each costs, then exit')
+    parser.add_argument('--profile', help='write a json summary of per-stage timings, memory and detection counts here')
+    parser.add_argument('--trace-memory', action='store_true', help='add tracemalloc peaks per stage to --profile (slower)')
+    parser.add_argument('--precision', choices=FACENET_PRECISIONS, default=FACENET_PRECISION,
+                        help='facenet autocast precision, embeddings stay float32 (see compare_backends.py)')
+    args = parser.parse_args(argv)
+    if args.backend == 'int8' and args.precision != 'float32':
+        parser.error('--precision only applies to the float backends, not int8')
+    return args
 
+def main(argv=None):
+    global FILE_PATH, CACHE_DIR, FACENET_BACKEND, FACENET_PRECISION, EMBED_BATCH_SIZE, DETECTION_TIERS
+    args = parse_args(argv)
+    FILE_PATH = args.image_root
+    FACENET_BACKEND = args.backend
+    FACENET_PRECISION = args.precision
+    if args.no_retry:
+        DETECTION_TIERS = DETECTION_TIERS[:1]
+    EMBED_BATCH_SIZE = args.batch_size
+    CACHE_DIR = args.cache_dir or os.path.join(args.image_root, 'embedding_cache')
+    if args.threads:
+        torch.set_num_threads(args.threads)
 
+    if args.failures:
+        report = failure_report(args.trials, args.image_root)
+        print(report.to_string(index=False) if len(report) else 'No registered detection failures')
+        return
 
+    errors_path = args.errors or os.path.splitext(args.output)[0] + '.errors.txt'
+    if args.profile:
+        enable_profiling(args.trace_memory)
 
-        
+    if args.incremental:
+        results, error_log, rescored = run_trials_incremental(args.metric, args.trials, args.image_root, None,
+                                                              args.batch_size, args.decode_threads, args.workers)
+        results.to_csv(args.output, index=False)
+        with open(errors_path, 'w') as errors_file:
+            errors_file.writelines(f"{error}\n" for error in error_log)
+        print(f"re-scored {rescored} new or changed trials", file=sys.stderr)
+        n_results, n_correct, n_errors = len(results), int(results['accuracy'].sum()), len(error_log)
+    else:
+        # rows and errors are flushed after every chunk so partial results can be read mid-run
+        n_results = n_correct = n_errors = 0
+        with open(args.output, 'w', newline='') as results_file, open(errors_path, 'w') as errors_file:
+            pd.DataFrame(columns=RESULT_COLUMNS).to_csv(results_file, index=False)
+            for results, error_log in stream_trials(args.trials, args.image_root, args.metric, args.chunk_size,
+                                                    args.batch_size, args.decode_threads, args.workers):
+                results.to_csv(results_file, header=False, index=False)
+                results_file.flush()
+                errors_file.writelines(f"{error}\n" for error in error_log)
+                errors_file.flush()
 
+                n_results += len(results)
+                n_correct += int(results['accuracy'].sum())
+                n_errors += len(error_log)
+                print(f"scored {n_results} trials, {n_errors} errors", file=sys.stderr)
 
+    print(f"Accuracy: {n_correct / n_results if n_results else float('nan'):.3f} over {n_results} trials")
+    print(f"\nErrors: {n_errors}")
 
+    if args.profile:
+        with open(args.profile, 'w') as f:
+            json.dump(disable_profiling(), f, indent=2)
 
+if __name__ == '__main__':
+    main()
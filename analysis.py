@@ -210,4 +210,5 @@ def calculate_hit_false_alarm_rates(folder_path='/Users/codylejang/Desktop/eyewi
     plot_proportion_correct(proportion_correct_short.tolist(), proportion_correct_long.tolist())
 
 
-calculate_hit_false_alarm_rates()
+if __name__ == '__main__':
+    calculate_hit_false_alarm_rates()
@@ -0,0 +1,157 @@
+import json
+import os
+import time
+import numpy as np
+
+# inverted-file (IVF) index over face embeddings: k-means splits the gallery into n_lists cells
+# and a query only scans the n_probe cells whose centroids are closest, so raising n_probe
+# trades speed for recall; candidates are re-ranked with exact euclidean distances, so the
+# returned distances follow the same decision rule as run_trials()
+
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLES_PER_LIST = 64
+ASSIGN_BLOCK_SIZE = 16384
+
+def _squared_distances(a, b, b_sq_norms=None):
+    if b_sq_norms is None:
+        b_sq_norms = np.einsum('ij,ij->i', b, b)
+    d = np.einsum('ij,ij->i', a, a)[:, None] + b_sq_norms[None, :] - 2 * (a @ b.T)
+    return np.maximum(d, 0)
+
+def _nearest_centroid(vectors, centroids):
+    centroid_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_BLOCK_SIZE):
+        block = vectors[start:start + ASSIGN_BLOCK_SIZE]
+        labels[start:start + len(block)] = _squared_distances(block, centroids, centroid_sq_norms).argmin(axis=1)
+    return labels
+
+class IVFIndex:
+    def __init__(self, n_lists=256, n_probe=8, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.seed = seed
+        self.centroids = None
+        self.vectors = None
+        self.sq_norms = None
+        self.ids = None
+        self.offsets = None
+
+    def __len__(self):
+        return 0 if self.ids is None else len(self.ids)
+
+    def build(self, embeddings):
+        # embeddings is an (n, 512) array, e.g. stacked get_embedding() vectors; search
+        # results refer to rows of this array
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        n_lists = min(self.n_lists, len(embeddings))
+        rng = np.random.default_rng(self.seed)
+
+        # k-means on a sample is enough to place the cells
+        sample_size = min(len(embeddings), n_lists * KMEANS_SAMPLES_PER_LIST)
+        sample = embeddings[rng.choice(len(embeddings), sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            labels = _nearest_centroid(sample, centroids)
+            counts = np.bincount(labels, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+            # re-seed empty cells from random sample points
+            centroids[~filled] = sample[rng.choice(sample_size, (~filled).sum())]
+
+        # store the gallery grouped by cell so each probe scans one contiguous slice
+        labels = _nearest_centroid(embeddings, centroids)
+        order = np.argsort(labels, kind='stable')
+        self.centroids = centroids
+        self.vectors = embeddings[order]
+        self.sq_norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+        self.ids = order
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_lists))])
+        return self
+
+    def search(self, queries, k=10, n_probe=None):
+        # top-k nearest gallery rows for each query, returns (distances, ids) of shape (n_queries, k);
+        # rows are padded with inf / -1 when the probed cells hold fewer than k faces
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+
+        cell_distances = _squared_distances(queries, self.centroids)
+        probes = np.argpartition(cell_distances, n_probe - 1, axis=1)[:, :n_probe]
+        for q, query in enumerate(queries):
+            rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in probes[q]])
+            if len(rows) == 0:
+                continue
+            d = self.sq_norms[rows] + query @ query - 2 * (self.vectors[rows] @ query)
+            top = np.argpartition(d, min(k, len(rows)) - 1)[:k]
+            top = top[np.argsort(d[top])]
+            distances[q, :len(top)] = np.sqrt(np.maximum(d[top], 0))
+            ids[q, :len(top)] = self.ids[rows[top]]
+        return distances, ids
+
+    def save(self, path):
+        # one .npy per array so the gallery can be reopened memory-mapped
+        os.makedirs(path, exist_ok=True)
+        for name in ['centroids', 'vectors', 'sq_norms', 'ids', 'offsets']:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump({'n_lists': self.n_lists, 'n_probe': self.n_probe, 'seed': self.seed}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(os.path.join(path, 'index.json')) as f:
+            index = cls(**json.load(f))
+        for name in ['centroids', 'vectors', 'sq_norms', 'ids', 'offsets']:
+            setattr(index, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode))
+        return index
+
+def brute_force_search(gallery, queries, k=10, gallery_sq_norms=None):
+    # exact top-k by scanning the whole gallery, the reference for recall
+    d = _squared_distances(np.atleast_2d(queries), gallery, gallery_sq_norms)
+    top = np.argpartition(d, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(top, np.take_along_axis(d, top, axis=1).argsort(axis=1), axis=1)
+    return np.sqrt(np.take_along_axis(d, top, axis=1)), top
+
+def synthetic_gallery(n_faces, n_identities=None, dim=512, intrinsic_dim=32, seed=0):
+    # unit vectors clustered around identities that lie near a low-dimensional subspace,
+    # roughly the geometry of facenet embeddings
+    rng = np.random.default_rng(seed)
+    n_identities = n_identities or max(1, n_faces // 4)
+    basis = rng.standard_normal((intrinsic_dim, dim)).astype(np.float32)
+    centers = rng.standard_normal((n_identities, intrinsic_dim)).astype(np.float32) @ basis
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    noise = rng.standard_normal((n_faces, dim)).astype(np.float32) / np.sqrt(dim)
+    faces = centers[rng.integers(n_identities, size=n_faces)] + 0.3 * noise
+    return faces / np.linalg.norm(faces, axis=1, keepdims=True)
+
+def benchmark(n_faces=100000, n_queries=200, k=10, n_lists=316, probes=(1, 4, 8, 16, 32), seed=0):
+    # recall@k and per-query latency of the ivf index against brute force on a synthetic gallery
+    gallery = synthetic_gallery(n_faces + n_queries, seed=seed)
+    gallery, queries = gallery[:n_faces], gallery[n_faces:]
+
+    start = time.perf_counter()
+    index = IVFIndex(n_lists=n_lists, seed=seed).build(gallery)
+    print(f"built {n_lists}-list index over {n_faces} faces in {time.perf_counter() - start:.2f}s")
+
+    # one query at a time, the same way the index is timed
+    gallery_sq_norms = np.einsum('ij,ij->i', gallery, gallery)
+    start = time.perf_counter()
+    exact_ids = np.concatenate([brute_force_search(gallery, query, k, gallery_sq_norms)[1] for query in queries])
+    brute_ms = (time.perf_counter() - start) / n_queries * 1000
+    print(f"brute force: recall@{k}=1.000  {brute_ms:.3f} ms/query")
+
+    results = []
+    for n_probe in probes:
+        start = time.perf_counter()
+        _, ids = index.search(queries, k, n_probe)
+        ms = (time.perf_counter() - start) / n_queries * 1000
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(ids, exact_ids)])
+        results.append({'n_probe': n_probe, 'recall': recall, 'ms_per_query': ms})
+        print(f"n_probe={n_probe:<4} recall@{k}={recall:.3f}  {ms:.3f} ms/query")
+    return results
+
+if __name__ == '__main__':
+    benchmark()
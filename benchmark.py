@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import torch
+import SDT_FACENET as sdt
+from stage_profiler import StageProfiler, peak_rss_mb
+
+# times the machine witness on synthetic trial tables drawn from the IMAGES/ pool: embedding (cold
+# and cached), trial scoring and csv i/o are measured separately and saved as json, so runs from
+# different commits on the same machine can be compared with --baseline
+
+SIZES = (100, 10000, 1000000)
+IMAGE_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'IMAGES')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results')
+
+def synthetic_trials(n_trials, image_root=IMAGE_ROOT, seed=0):
+    # rows laid out like eyewitness_trials.csv: lineup k shows suspectk, then targetk and innocentk
+    # with the target on a random side, at one of the two encoding durations
+    lineups = sorted(int(m.group(1)) for m in map(re.compile(r'target(\d+)\.png$').match, os.listdir(image_root)) if m)
+    rng = np.random.default_rng(seed)
+    k = np.array(lineups)[rng.integers(len(lineups), size=n_trials)].astype(str)
+    target_left = rng.random(n_trials) < 0.5
+    target = np.char.add(np.char.add('target', k), '.png')
+    innocent = np.char.add(np.char.add('innocent', k), '.png')
+    return pd.DataFrame({
+        'encoding_image': np.char.add(np.char.add('suspect', k), '.png'),
+        'target_image': target,
+        'innocent_image': innocent,
+        'correct_position': np.where(target_left, 'left', 'right'),
+        'left_image': np.where(target_left, target, innocent),
+        'right_image': np.where(target_left, innocent, target),
+        'encoding_duration': rng.choice([0.4, 1.5], n_trials)
+    })
+
+def machine_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'device': str(sdt.device),
+        'backend': sdt.FACENET_BACKEND,
+        'precision': sdt.FACENET_PRECISION
+    }
+
+def benchmark_embedding(image_paths):
+    # cold: empty caches, every image decoded, detected and embedded; warm: all embedding cache hits
+    sdt.enable_profiling()
+    start = time.perf_counter()
+    embeddings = sdt.embed_images(image_paths)
+    cold = time.perf_counter() - start
+    profile = sdt.disable_profiling()
+
+    start = time.perf_counter()
+    sdt.embed_images(image_paths)
+    warm = time.perf_counter() - start
+
+    report = {
+        'images': len(image_paths),
+        'cold_s': cold,
+        'cold_images_per_sec': len(image_paths) / cold,
+        'warm_s': warm,
+        'warm_images_per_sec': len(image_paths) / warm,
+        'peak_rss_mb': max(profile['peak_rss_mb'], peak_rss_mb()),
+        'counts': profile['counts'],
+        'stages': profile['stages']
+    }
+    return report, embeddings
+
+def benchmark_trials(n_trials, embeddings, workdir, image_root=IMAGE_ROOT, metric='euclidean',
+                     chunk_size=sdt.TRIAL_CHUNK_SIZE, seed=0, trace_memory=False):
+    profiler = StageProfiler(trace_memory)
+    trials = synthetic_trials(n_trials, image_root, seed)
+    trials_path = os.path.join(workdir, f'trials-{n_trials}.csv')
+    results_path = os.path.join(workdir, f'results-{n_trials}.csv')
+
+    with profiler.stage('write_trials', n_trials):
+        trials.to_csv(trials_path, index=False)
+    del trials
+    with profiler.stage('read_trials', n_trials):
+        loadouts = pd.read_csv(trials_path)
+
+    names = pd.unique(loadouts[sdt.IMAGE_COLUMNS].values.ravel())
+    matrix, rows = sdt.embedding_matrix(names, embeddings, image_root)
+    with profiler.stage('scoring', n_trials):
+        results, _ = sdt.score_loadouts(loadouts, matrix, rows, metric)
+    with profiler.stage('write_results', len(results)):
+        results.to_csv(results_path, index=False)
+    del loadouts, results
+
+    # end to end the way the cli runs: chunked read, cached embeddings, scoring and streamed writes
+    with profiler.stage('stream', n_trials), open(results_path, 'w', newline='') as f:
+        for results, _ in sdt.stream_trials(trials_path, image_root, metric, chunk_size):
+            results.to_csv(f, header=False, index=False)
+
+    summary = profiler.summary()
+    return {
+        'trials': n_trials,
+        'trials_per_sec': summary['stages']['stream']['items_per_sec'],
+        'scoring_trials_per_sec': summary['stages']['scoring']['items_per_sec'],
+        'peak_rss_mb': summary['peak_rss_mb'],
+        'stages': summary['stages']
+    }
+
+def run_benchmark(sizes=SIZES, image_root=IMAGE_ROOT, metric='euclidean', chunk_size=sdt.TRIAL_CHUNK_SIZE, seed=0,
+                  trace_memory=False):
+    # caches and csvs go to a scratch directory so every run starts cold; each size's peak rss is
+    # measured from the start of its own run (see StageProfiler), so it is that size's footprint
+    workdir = tempfile.mkdtemp(prefix='sdt_benchmark_')
+    sdt.FILE_PATH = image_root
+    sdt.CACHE_DIR = os.path.join(workdir, 'embedding_cache')
+    try:
+        image_names = pd.unique(synthetic_trials(max(sizes), image_root, seed)[sdt.IMAGE_COLUMNS].values.ravel())
+        embedding, embeddings = benchmark_embedding([os.path.join(image_root, name) for name in image_names])
+        print(f"embedding: {embedding['cold_images_per_sec']:.1f} images/sec cold, "
+              f"{embedding['warm_images_per_sec']:.1f} cached", file=sys.stderr)
+
+        trials = []
+        for n_trials in sorted(sizes):
+            trials.append(benchmark_trials(n_trials, embeddings, workdir, image_root, metric, chunk_size, seed,
+                                           trace_memory))
+            print(f"{n_trials} trials: {trials[-1]['trials_per_sec']:.0f} trials/sec end to end, "
+                  f"{trials[-1]['scoring_trials_per_sec']:.0f} scored/sec, "
+                  f"peak rss {trials[-1]['peak_rss_mb']:.0f} MB", file=sys.stderr)
+    finally:
+        tracemalloc.stop()
+        shutil.rmtree(workdir)
+    return {'machine': machine_info(), 'metric': metric, 'chunk_size': chunk_size, 'trace_memory': trace_memory,
+            'embedding': embedding, 'trials': trials}
+
+def compare(report, baseline):
+    # ratio of each throughput to the baseline run, above 1 is faster
+    ratios = {'cold_images_per_sec': report['embedding']['cold_images_per_sec'] / baseline['embedding']['cold_images_per_sec']}
+    previous = {run['trials']: run for run in baseline['trials']}
+    for run in report['trials']:
+        if run['trials'] in previous:
+            for key in ['trials_per_sec', 'scoring_trials_per_sec']:
+                ratios[f"{run['trials']}_{key}"] = run[key] / previous[run['trials']][key]
+    return ratios
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the machine witness on synthetic trial tables.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES), help='trial table sizes to run')
+    parser.add_argument('--image-root', default=IMAGE_ROOT)
+    parser.add_argument('--metric', choices=sdt.METRICS, default='euclidean')
+    parser.add_argument('--chunk-size', type=int, default=sdt.TRIAL_CHUNK_SIZE)
+    parser.add_argument('--backend', choices=sdt.FACENET_BACKENDS, default=sdt.FACENET_BACKEND)
+    parser.add_argument('--output', help=f'results json (default: {os.path.basename(RESULTS_DIR)}/<commit>-<time>.json)')
+    parser.add_argument('--trace-memory', action='store_true', help='record tracemalloc peaks per stage (slows the timings)')
+    parser.add_argument('--baseline', help='earlier results json to report speed ratios against')
+    args = parser.parse_args()
+
+    sdt.FACENET_BACKEND = args.backend
+    report = run_benchmark(args.sizes, args.image_root, args.metric, args.chunk_size, trace_memory=args.trace_memory)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['vs_baseline'] = compare(report, json.load(f))
+        print(json.dumps(report['vs_baseline'], indent=2))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['machine']['commit']}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"saved {output}", file=sys.stderr)
@@ -218,4 +218,5 @@ def calculate_hit_false_alarm_rates(folder_path='/Users/codylejang/Desktop/eyewi
     plot_participant_level_dprime_lambda(d_prime_short, d_prime_long, lambda_short, lambda_long)
     plot_proportion_correct(proportion_correct_short.tolist(), proportion_correct_long.tolist())
 # Call the function
-calculate_hit_false_alarm_rates()
+if __name__ == '__main__':
+    calculate_hit_false_alarm_rates()
@@ -0,0 +1,148 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import torch
+import SDT_FACENET as sdt
+from stage_profiler import peak_rss_mb
+
+# compares a facenet backend and/or autocast precision against the float32 eager model on the
+# trial stimuli: embedding speed, weight memory, embedding drift and how often the 2AFC decision flips
+
+def model_bytes(model):
+    # serialised size of the weights, what holding the model costs in memory; frozen torchscript
+    # folds its weights into graph constants, so there is nothing to measure and None is returned
+    state_dict = model.state_dict()
+    if not state_dict:
+        return None
+    buffer = io.BytesIO()
+    torch.save(state_dict, buffer)
+    return buffer.getbuffer().nbytes / 2**20
+
+def time_embedding(model, crops, batch_size, repeats, precision='float32'):
+    # best of `repeats` full passes after one warm-up batch
+    sdt.embed_faces(crops[:batch_size], batch_size, model, precision)
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        embeddings = sdt.embed_faces(crops, batch_size, model, precision)
+        best = min(best, time.perf_counter() - start)
+    return embeddings, best
+
+def compare_backend(backend, trials_path=None, image_root=None, metric='euclidean',
+                    batch_size=sdt.EMBED_BATCH_SIZE, repeats=3, precision='float32'):
+    image_root = image_root or sdt.FILE_PATH
+    loadouts = pd.read_csv(trials_path or sdt.default_trials_path(image_root))
+    names = pd.unique(loadouts[sdt.IMAGE_COLUMNS].values.ravel())
+
+    # detect once so both models embed exactly the same crops
+    crops, _ = sdt.detect_faces_tiered([sdt.load_image(os.path.join(image_root, name)) for name in names])
+    detected = [i for i, crop in enumerate(crops) if crop is not None]
+    faces = [crops[i] for i in detected]
+    rows = {names[i]: row for row, i in enumerate(detected)}
+
+    reference = sdt.build_facenet('eager', 'float32')
+    candidate = sdt.build_facenet(backend, precision)
+    reference_embeddings, reference_time = time_embedding(reference, faces, batch_size, repeats)
+    candidate_embeddings, candidate_time = time_embedding(candidate, faces, batch_size, repeats, precision)
+
+    reference_results, _ = sdt.score_loadouts(loadouts, reference_embeddings, rows, metric)
+    candidate_results, _ = sdt.score_loadouts(loadouts, candidate_embeddings, rows, metric)
+    flipped = reference_results['predicted'] != candidate_results['predicted']
+    drift = np.linalg.norm(reference_embeddings - candidate_embeddings, axis=1)
+
+    return {
+        'backend': backend,
+        'precision': precision,
+        'images': len(faces),
+        'eager_images_per_sec': len(faces) / reference_time,
+        'backend_images_per_sec': len(faces) / candidate_time,
+        'speedup': reference_time / candidate_time,
+        'eager_model_mb': model_bytes(reference),
+        'backend_model_mb': model_bytes(candidate),
+        'embedding_drift_mean': float(drift.mean()),
+        'embedding_drift_max': float(drift.max()),
+        'trials': len(reference_results),
+        'decisions_flipped': int(flipped.sum()),
+        'flip_rate': float(flipped.mean()) if len(flipped) else 0.0,
+        'eager_accuracy': float(reference_results['accuracy'].mean()),
+        'backend_accuracy': float(candidate_results['accuracy'].mean())
+    }
+
+def _load_and_embed(slim, crops, batch_size):
+    # runs in a fresh process so startup time and peak rss belong to this model variant alone
+    start = time.perf_counter()
+    model = sdt.load_facenet(slim)
+    load_time = time.perf_counter() - start
+    rss_loaded = peak_rss_mb()
+    embeddings = sdt.embed_faces(crops, batch_size, model)
+    return load_time, rss_loaded, peak_rss_mb(), model_bytes(model), embeddings
+
+def compare_slim(trials_path=None, image_root=None, batch_size=sdt.EMBED_BATCH_SIZE, repeats=3):
+    # full vggface2 model (with its unused classifier) against the slim embedding-only model:
+    # weight file size, weight memory, load time and peak rss in a fresh process, and a bit-for-bit check.
+    # weights are memory-mapped and the classifier is never run, so the saving shows in weights_mb (what
+    # any copy of the model costs: int8 quantisation, moving to a gpu) more than in eager rss
+    image_root = image_root or sdt.FILE_PATH
+    loadouts = pd.read_csv(trials_path or sdt.default_trials_path(image_root))
+    names = pd.unique(loadouts[sdt.IMAGE_COLUMNS].values.ravel())
+    crops, _ = sdt.detect_faces_tiered([sdt.load_image(os.path.join(image_root, name)) for name in names])
+    faces = [crop for crop in crops if crop is not None]
+    sdt.save_facenet_weights()
+
+    settings = {name: getattr(sdt, name) for name in sdt.WORKER_SETTINGS}
+    report = {'images': len(faces)}
+    outputs = {}
+    for variant, slim in [('full', False), ('slim', True)]:
+        runs = []
+        for _ in range(repeats):
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'), initializer=sdt._init_worker,
+                                     initargs=(settings, torch.get_num_threads(), None)) as pool:
+                runs.append(pool.submit(_load_and_embed, slim, faces, batch_size).result())
+        # best of the repeats for each figure, peak rss moves by tens of MB between identical runs
+        load_times, rss_loaded, rss_peak, weights_mb, embeddings = zip(*runs)
+        outputs[variant] = embeddings[0]
+        report[variant] = {
+            'weights_file_mb': os.path.getsize(sdt.facenet_weights_path(slim)) / 2**20,
+            'weights_mb': weights_mb[0],
+            'load_s': min(load_times),
+            'rss_after_load_mb': min(rss_loaded),
+            'peak_rss_mb': min(rss_peak)
+        }
+    report['load_speedup'] = report['full']['load_s'] / report['slim']['load_s']
+    report['weights_saved_mb'] = report['full']['weights_mb'] - report['slim']['weights_mb']
+    report['peak_rss_saved_mb'] = report['full']['peak_rss_mb'] - report['slim']['peak_rss_mb']
+    report['bit_identical'] = bool(np.array_equal(outputs['full'], outputs['slim']))
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare a facenet backend against the float32 eager model.')
+    parser.add_argument('--backend', choices=sdt.FACENET_BACKENDS, default='int8')
+    parser.add_argument('--precision', choices=sdt.FACENET_PRECISIONS, default='float32',
+                        help='autocast precision of the compared model, e.g. --backend eager --precision bfloat16')
+    parser.add_argument('--trials', help='trial CSV (default: <image-root>/eyewitness_trials.csv, else the one next to the code)')
+    parser.add_argument('--image-root', default=sdt.FILE_PATH)
+    parser.add_argument('--metric', choices=sdt.METRICS, default='euclidean')
+    parser.add_argument('--batch-size', type=int, default=sdt.EMBED_BATCH_SIZE)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--slim', action='store_true',
+                        help='instead compare the slim embedding-only model with the full vggface2 model')
+    args = parser.parse_args()
+    sdt.FILE_PATH = args.image_root
+    # the torchscript and compiled backends are built for one batch shape, as in SDT_FACENET.main()
+    sdt.EMBED_BATCH_SIZE = args.batch_size
+    if args.slim:
+        report = compare_slim(args.trials, args.image_root, args.batch_size, args.repeats)
+    else:
+        if args.backend == 'eager' and args.precision == 'float32':
+            parser.error('nothing to compare, pick a --backend other than eager or a lower --precision')
+        if args.backend == 'int8' and args.precision != 'float32':
+            parser.error('--precision only applies to the float backends, not int8')
+        report = compare_backend(args.backend, args.trials, args.image_root, args.metric, args.batch_size,
+                                 args.repeats, args.precision)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,221 @@
+import argparse
+import math
+import os
+import sys
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+import SDT_FACENET as sdt
+from face_cache import EmbeddingCache
+from trial_scoring import METRICS, score_trials
+
+# accuracy of the machine witness as the encoding image degrades, the machine counterpart of the
+# 0.4 s vs 1.5 s exposure manipulation. degradations run as batched tensor ops on the cached uint8
+# face crops of the encoding images, one level over a whole batch at a time, and every trial is
+# scored at every level from one stacked embedding matrix. target and innocent images stay clean.
+# degraded embeddings are cached per degradation and level, so adding a level only embeds that level
+
+# levels per degradation, the first is the undegraded crop
+DEGRADATIONS = {
+    'blur': [0, 1, 2, 4, 8],                    # gaussian sigma in crop pixels
+    'noise': [0, 8, 16, 32, 64],                # gaussian noise std on 0-255 pixel values
+    'downsample': [1, 2, 4, 8, 16],             # crop resolution divided by this, then scaled back up
+    'occlusion': [0, 0.1, 0.25, 0.5, 0.75],     # fraction of the crop hidden by a centred grey square
+    'contrast': [0, 0.25, 0.5, 0.75, 0.9]       # fraction of contrast removed around the crop's mean
+}
+# the level of each degradation that leaves the crop unchanged
+NO_DEGRADATION = {'downsample': 1}
+
+def blur_matrix(size, sigma, dtype):
+    # 1-d gaussian with reflected borders as a (size, size) banded matrix, so blurring a whole batch
+    # is two matmuls, which runs several times faster on cpu than a grouped conv2d
+    radius = min(math.ceil(3 * sigma), size - 1)
+    offsets = torch.arange(-radius, radius + 1)
+    kernel = torch.exp(-offsets.to(dtype) ** 2 / (2 * sigma ** 2))
+    columns = (torch.arange(size)[:, None] + offsets[None, :]).abs()
+    columns = torch.where(columns >= size, 2 * (size - 1) - columns, columns)
+    matrix = torch.zeros(size, size, dtype=dtype)
+    matrix.index_put_((torch.arange(size)[:, None].expand_as(columns), columns),
+                      (kernel / kernel.sum()).expand_as(columns), accumulate=True)
+    return matrix
+
+def blur(pixels, sigma):
+    height, width = pixels.shape[-2:]
+    return blur_matrix(height, sigma, pixels.dtype) @ pixels @ blur_matrix(width, sigma, pixels.dtype).T
+
+def add_noise(pixels, std, seeds):
+    # one generator per image, so an image gets the same noise whatever batch it lands in
+    noise = torch.stack([torch.randn(pixels.shape[1:], generator=torch.Generator().manual_seed(seed))
+                         for seed in seeds])
+    return pixels + std * noise
+
+def downsample(pixels, factor):
+    size = [max(1, round(side / factor)) for side in pixels.shape[-2:]]
+    small = F.interpolate(pixels, size=size, mode='area')
+    return F.interpolate(small, size=pixels.shape[-2:], mode='bilinear', align_corners=False)
+
+def occlude(pixels, fraction):
+    # mid grey, which is zero once the crop is standardised for facenet
+    height, width = pixels.shape[-2:]
+    side_h, side_w = round(height * math.sqrt(fraction)), round(width * math.sqrt(fraction))
+    top, left = (height - side_h) // 2, (width - side_w) // 2
+    pixels = pixels.clone()
+    pixels[..., top:top + side_h, left:left + side_w] = 127.5
+    return pixels
+
+def reduce_contrast(pixels, loss):
+    mean = pixels.mean(dim=(1, 2, 3), keepdim=True)
+    return mean + (pixels - mean) * (1 - loss)
+
+def degrade(pixels, degradation, level, seeds=None):
+    # (n, 3, h, w) uint8 crops in, degraded uint8 crops out, quantised like a degraded stimulus would be
+    pixels = pixels.float()
+    if degradation == 'blur':
+        pixels = blur(pixels, level)
+    elif degradation == 'noise':
+        pixels = add_noise(pixels, level, seeds)
+    elif degradation == 'downsample':
+        pixels = downsample(pixels, level)
+    elif degradation == 'occlusion':
+        pixels = occlude(pixels, level)
+    elif degradation == 'contrast':
+        pixels = reduce_contrast(pixels, level)
+    else:
+        raise ValueError(f"Unknown degradation {degradation!r}, expected one of {tuple(DEGRADATIONS)}")
+    return pixels.round().clamp(0, 255).to(torch.uint8)
+
+def noise_seed(key, seed):
+    return (int(key[:15], 16) + seed) % 2**63
+
+def degraded_cache(degradation, level, seed=0):
+    # one embedding cache per degradation and level, next to the clean one; only noise depends on the seed
+    config = {**sdt.embedding_config(), 'degradation': degradation, 'level': level}
+    if degradation == 'noise':
+        config['seed'] = seed
+    return EmbeddingCache(os.path.join(sdt.CACHE_DIR, 'degraded'), config)
+
+def degraded_embeddings(crops, keys, degradation, level, batch_size=sdt.EMBED_BATCH_SIZE, seed=0):
+    # (n, 512) embeddings of the crops at one level, embedding only those not cached yet
+    cache = degraded_cache(degradation, level, seed)
+    embeddings = np.empty((len(keys), 512), dtype=np.float32)
+    missing = []
+    for i, key in enumerate(keys):
+        embedding = cache.get(key)
+        if embedding is None:
+            missing.append(i)
+        else:
+            embeddings[i] = embedding
+    sdt.count('degraded_cache_hits', len(keys) - len(missing))
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        with sdt.stage('degrade', len(batch)):
+            pixels = degrade(crops[batch], degradation, level, [noise_seed(keys[i], seed) for i in batch])
+        faces = sdt.decode_crop(pixels.numpy())
+        embeddings[batch] = sdt.embed_faces(list(faces), batch_size)
+        for i in batch:
+            cache.put(keys[i], embeddings[i])
+    cache.flush()
+    return embeddings
+
+def run_sweep(trials_path=None, image_root=None, metric='euclidean', degradations=None,
+              batch_size=sdt.EMBED_BATCH_SIZE, seed=0):
+    # one row per trial, degradation and level, laid out like run_trials() results; trials with an
+    # undetected face are left out as they are there. returns (results, error_log)
+    image_root = image_root or sdt.FILE_PATH
+    degradations = degradations or DEGRADATIONS
+    loadouts = pd.read_csv(trials_path or sdt.default_trials_path(image_root))
+    names = pd.unique(loadouts[sdt.IMAGE_COLUMNS].values.ravel())
+    embeddings = sdt.embed_images([os.path.join(image_root, name) for name in names], batch_size)
+    matrix, rows = sdt.embedding_matrix(names, embeddings, image_root)
+    _, error_log = sdt.score_loadouts(loadouts, matrix, rows, metric)
+
+    encoding_names = [name for name in pd.unique(loadouts['encoding_image']) if name in rows]
+    if not encoding_names:
+        raise ValueError("no face was detected in any encoding image, there is nothing to degrade")
+    encoding_paths = [os.path.join(image_root, name) for name in encoding_names]
+    keys = [sdt.image_hash(image_path) for image_path in encoding_paths]
+    crops = sdt.face_crops(encoding_paths, keys)
+    crops = torch.from_numpy(np.stack([crops[image_path] for image_path in encoding_paths]))
+    encoding_rows = {name: i for i, name in enumerate(encoding_names)}
+
+    # clean rows first, then one block of encoding rows per level; the undegraded level reuses the
+    # clean embeddings, so it matches run_trials() exactly
+    blocks = [matrix]
+    levels = []
+    clean = matrix[[rows[name] for name in encoding_names]]
+    for degradation, degradation_levels in degradations.items():
+        for level in degradation_levels:
+            if level == NO_DEGRADATION.get(degradation, 0):
+                blocks.append(clean)
+            else:
+                blocks.append(degraded_embeddings(crops, keys, degradation, level, batch_size, seed))
+            levels.append((degradation, level))
+            print(f"embedded {degradation} {level}", file=sys.stderr)
+    stacked = np.concatenate(blocks)
+
+    valid = np.logical_and.reduce([loadouts[column].isin(rows).to_numpy() for column in sdt.IMAGE_COLUMNS])
+    trials = loadouts[valid]
+    correct_position = trials['correct_position'].str.strip().str.lower().to_numpy()
+    encoding_idx = trials['encoding_image'].map(encoding_rows).to_numpy(dtype=int)
+    offsets = len(matrix) + len(encoding_names) * np.arange(len(levels))
+
+    # every trial at every level in one vectorised pass
+    n_levels = len(levels)
+    with sdt.stage('scoring', len(trials) * n_levels):
+        scores = score_trials(
+            stacked,
+            (offsets[:, None] + encoding_idx[None, :]).ravel(),
+            np.tile(trials['left_image'].map(rows).to_numpy(dtype=int), n_levels),
+            np.tile(trials['right_image'].map(rows).to_numpy(dtype=int), n_levels),
+            np.tile(correct_position == 'left', n_levels),
+            metric
+        )
+
+    results = pd.DataFrame({
+        'trial': np.tile(trials.index, n_levels),
+        'degradation': np.repeat([degradation for degradation, _ in levels], len(trials)),
+        'level': np.repeat([level for _, level in levels], len(trials)),
+        'predicted': np.where(scores['predicted_left'], 'left', 'right'),
+        'correct_position': np.tile(correct_position, n_levels),
+        'accuracy': scores['accuracy'],
+        'dist_left': scores['dist_left'],
+        'dist_right': scores['dist_right'],
+        'margin': scores['margin']
+    })
+    if 'encoding_duration' in loadouts:
+        results['encoding_duration'] = np.tile(trials['encoding_duration'].to_numpy(), n_levels)
+    return results, error_log
+
+def sweep_curves(results, by=None):
+    # accuracy (and mean margin) against level for each degradation, split by the `by` columns
+    groups = ['degradation', 'level'] + list(by or [])
+    curves = results.groupby(groups, sort=False).agg(trials=('accuracy', 'size'), accuracy=('accuracy', 'mean'),
+                                                    margin=('margin', 'mean'))
+    return curves.reset_index()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Machine witness accuracy against degradation of the encoding image.')
+    parser.add_argument('--trials', help='trial CSV (default: <image-root>/eyewitness_trials.csv, else the one next to the code)')
+    parser.add_argument('--image-root', default=sdt.FILE_PATH)
+    parser.add_argument('--cache-dir', help='embedding cache directory (default: <image-root>/embedding_cache)')
+    parser.add_argument('--metric', choices=METRICS, default='euclidean')
+    parser.add_argument('--batch-size', type=int, default=sdt.EMBED_BATCH_SIZE, help='degraded crops per facenet forward pass')
+    parser.add_argument('--degradations', nargs='+', choices=list(DEGRADATIONS), default=list(DEGRADATIONS),
+                        help='degradations to sweep, each over its DEGRADATIONS levels')
+    parser.add_argument('--seed', type=int, default=0, help='noise seed')
+    parser.add_argument('--output', default='degradation_sweep.csv', help='per-trial results at every level')
+    parser.add_argument('--curves', default='degradation_curves.csv', help='accuracy per degradation and level')
+    args = parser.parse_args()
+
+    sdt.FILE_PATH = args.image_root
+    sdt.CACHE_DIR = args.cache_dir or os.path.join(args.image_root, 'embedding_cache')
+    results, error_log = run_sweep(args.trials, args.image_root, args.metric,
+                                   {name: DEGRADATIONS[name] for name in args.degradations}, args.batch_size, args.seed)
+    # split by exposure when the trial table has it
+    curves = sweep_curves(results, [column for column in ['encoding_duration'] if column in results])
+    results.to_csv(args.output, index=False)
+    curves.to_csv(args.curves, index=False)
+    print(curves.to_string(index=False))
+    print(f"\nErrors: {len(error_log)} (trials with an undetected face are left out of every level)")
@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+import glob
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import pandas as pd
+import SDT_FACENET as sdt
+
+# asyncio front end over the decode -> detect -> embed stages, for one long-running process that
+# embeds several trial files or image directories at once. every job feeds the same bounded queues,
+# so jobs share one mtcnn and one facenet instance and their images are batched together; an image
+# two jobs ask for at the same time is only processed once. a full queue makes the job feeding it
+# wait (backpressure), and the cpu-bound work runs in executors so the event loop stays responsive
+
+QUEUE_SIZE = 256
+# how long a partial batch waits for more items before it is run anyway
+BATCH_WAIT = 0.01
+
+class EmbeddingJob:
+    # handle for one submitted set of images: progress, cancellation and, once awaited,
+    # the {image_path: embedding or None} dict that embed_images() would have returned
+    def __init__(self, name, image_paths, on_progress=None):
+        self.name = name
+        self.image_paths = list(dict.fromkeys(image_paths))
+        self.total = len(self.image_paths)
+        self.done = 0
+        self.failures = []
+        self.embeddings = {}
+        self.on_progress = on_progress
+        self.task = None
+
+    @property
+    def progress(self):
+        return self.done / self.total if self.total else 1.0
+
+    def cancel(self):
+        return self.task.cancel()
+
+    def __await__(self):
+        return self.task.__await__()
+
+class EmbeddingService:
+    def __init__(self, batch_size=sdt.EMBED_BATCH_SIZE, detect_batch_size=sdt.DETECT_BATCH_SIZE,
+                 decode_threads=sdt.DECODE_THREADS, queue_size=QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.detect_batch_size = detect_batch_size
+        self.decode_threads = decode_threads
+        self.queue_size = queue_size
+        self._stages = []
+        self._jobs = set()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def start(self):
+        # hashing and png decode share a thread pool; each model gets one thread of its own, so
+        # detection of one batch overlaps with embedding of the previous one
+        self._io = ThreadPoolExecutor(self.decode_threads)
+        self._detector = ThreadPoolExecutor(1)
+        self._embedder = ThreadPoolExecutor(1)
+        self._decode_queue = asyncio.Queue(self.queue_size)
+        self._detect_queue = asyncio.Queue(self.queue_size)
+        self._embed_queue = asyncio.Queue(self.queue_size)
+        # one future per image being processed, and how many unfinished jobs are waiting on it
+        self._inflight = {}
+        self._interest = {}
+        self._embedding_cache = sdt.get_embedding_cache()
+        self._crop_cache = sdt.get_crop_cache()
+        self._failure_registry = sdt.get_failure_registry()
+        self._stages = [asyncio.create_task(self._decode_stage()) for _ in range(self.decode_threads)]
+        self._stages += [asyncio.create_task(self._detect_stage()), asyncio.create_task(self._embed_stage())]
+
+    async def close(self):
+        for task in list(self._jobs) + self._stages:
+            task.cancel()
+        await asyncio.gather(*self._jobs, *self._stages, return_exceptions=True)
+        for executor in [self._io, self._detector, self._embedder]:
+            executor.shutdown(wait=True)
+        self._crop_cache.flush()
+        self._embedding_cache.flush()
+        self._failure_registry.flush()
+
+    def submit(self, image_paths, name=None, on_progress=None):
+        # start embedding a set of images, on_progress(job) is called after every finished image
+        job = EmbeddingJob(name or f'job-{len(self._jobs)}', image_paths, on_progress)
+        job.task = self._track(asyncio.create_task(self._run_job(job)))
+        return job
+
+    def _track(self, task):
+        # tasks close() cancels and waits for
+        self._jobs.add(task)
+        task.add_done_callback(self._jobs.discard)
+        return task
+
+    def embed_directory(self, directory, pattern='*.png', on_progress=None):
+        return self.submit(sorted(glob.glob(os.path.join(directory, pattern))), directory, on_progress)
+
+    async def run_trials(self, trials_path, image_root=None, metric='euclidean', on_progress=None):
+        # the service counterpart of sdt.run_trials(), returns (results, error_log)
+        loop = asyncio.get_running_loop()
+        image_root = image_root or sdt.FILE_PATH
+        loadouts = await loop.run_in_executor(self._io, pd.read_csv, trials_path)
+        names = pd.unique(loadouts[sdt.IMAGE_COLUMNS].values.ravel())
+        embeddings = await self.submit([os.path.join(image_root, name) for name in names], trials_path, on_progress)
+        matrix, rows = sdt.embedding_matrix(names, embeddings, image_root)
+        return await loop.run_in_executor(self._io, sdt.score_loadouts, loadouts, matrix, rows, metric)
+
+    async def _run_job(self, job):
+        loop = asyncio.get_running_loop()
+        claimed = []
+        waiting = []
+        try:
+            for image_path in job.image_paths:
+                key = await loop.run_in_executor(self._io, sdt.image_hash, image_path)
+                embedding = self._embedding_cache.get(key)
+                if embedding is not None or key in self._failure_registry:
+                    self._record(job, image_path, embedding, known_failure=embedding is None)
+                    continue
+
+                self._interest[key] = self._interest.get(key, 0) + 1
+                claimed.append(key)
+                future = self._inflight.get(key)
+                if future is None:
+                    future = self._inflight[key] = loop.create_future()
+                    try:
+                        await self._enqueue(image_path, key)
+                    except asyncio.CancelledError:
+                        # cancelled while waiting on a full queue, so the image never got queued and
+                        # nothing would finish its future: queue it in the background if another job
+                        # has started waiting on it meanwhile, otherwise drop it so a later job starts afresh
+                        if self._interest[key] > 1:
+                            self._track(asyncio.create_task(self._enqueue(image_path, key)))
+                        else:
+                            del self._inflight[key]
+                            future.cancel()
+                        raise
+                future.add_done_callback(partial(self._collect, job, image_path))
+                waiting.append(future)
+
+            # asyncio.wait rather than gather, cancelling this job must not cancel futures other jobs share
+            if waiting:
+                await asyncio.wait(waiting)
+            for future in waiting:
+                if future.exception() is not None:
+                    raise future.exception()
+            self._embedding_cache.flush()
+            self._crop_cache.flush()
+            self._failure_registry.flush()
+            return job.embeddings
+        finally:
+            # images nobody waits on any more are dropped by the next stage that sees them
+            for key in claimed:
+                self._interest[key] -= 1
+                if not self._interest[key]:
+                    del self._interest[key]
+
+    async def _enqueue(self, image_path, key):
+        # images with a cached crop skip decode and detection
+        pixels = self._crop_cache.get(key)
+        if pixels is not None:
+            await self._embed_queue.put((key, sdt.decode_crop(pixels)))
+        else:
+            await self._decode_queue.put((image_path, key))
+
+    def _record(self, job, image_path, embedding, known_failure=False):
+        job.embeddings[image_path] = embedding
+        job.done += 1
+        if embedding is None:
+            job.failures.append(image_path)
+            if not known_failure:
+                print(f"Face not detected in {image_path}")
+        if job.on_progress is not None:
+            job.on_progress(job)
+
+    def _collect(self, job, image_path, future):
+        if not future.cancelled() and future.exception() is None:
+            self._record(job, image_path, future.result())
+
+    def _wanted(self, key):
+        if self._interest.get(key):
+            return True
+        future = self._inflight.pop(key, None)
+        if future is not None:
+            future.cancel()
+        return False
+
+    def _finish(self, key, embedding=None, error=None):
+        future = self._inflight.pop(key, None)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(embedding)
+
+    async def _next_batch(self, queue, size):
+        # block for the first item, then take whatever else arrives within BATCH_WAIT
+        loop = asyncio.get_running_loop()
+        batch = [await queue.get()]
+        deadline = loop.time() + BATCH_WAIT
+        while len(batch) < size:
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _decode_stage(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            image_path, key = await self._decode_queue.get()
+            if not self._wanted(key):
+                continue
+            try:
+                image = await loop.run_in_executor(self._io, sdt.load_image, image_path)
+            except OSError as error:
+                self._finish(key, error=error)
+                continue
+            await self._detect_queue.put((key, image_path, image))
+
+    async def _detect_stage(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [item for item in await self._next_batch(self._detect_queue, self.detect_batch_size)
+                     if self._wanted(item[0])]
+            if not batch:
+                continue
+            try:
+                crops, tiers = await loop.run_in_executor(self._detector, sdt.detect_faces_tiered,
+                                                          [image for _, _, image in batch], self.detect_batch_size)
+            except Exception as error:
+                for key, _, _ in batch:
+                    self._finish(key, error=error)
+                continue
+            for (key, image_path, _), crop, tier in zip(batch, crops, tiers):
+                if crop is None:
+                    self._failure_registry.add(key, image_path)
+                    self._finish(key, None)
+                    continue
+                self._crop_cache.put(key, sdt.encode_crop(crop), tier)
+                await self._embed_queue.put((key, crop))
+
+    async def _embed_stage(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [(key, crop) for key, crop in await self._next_batch(self._embed_queue, self.batch_size)
+                     if self._wanted(key)]
+            if not batch:
+                continue
+            try:
+                embeddings = await loop.run_in_executor(self._embedder, sdt.embed_faces,
+                                                        [crop for _, crop in batch], self.batch_size)
+            except Exception as error:
+                for key, _ in batch:
+                    self._finish(key, error=error)
+                continue
+            for (key, _), embedding in zip(batch, embeddings):
+                self._embedding_cache.put(key, embedding)
+                self._finish(key, embedding)
+
+async def run_trial_sets(trials_paths, image_root=None, metric='euclidean', batch_size=sdt.EMBED_BATCH_SIZE):
+    # score several trial files concurrently through one service, printing progress per file
+    def report(job):
+        print(f"{job.name}: {job.done}/{job.total} images ({len(job.failures)} without a face)", file=sys.stderr)
+
+    async with EmbeddingService(batch_size) as service:
+        outcomes = await asyncio.gather(*[service.run_trials(path, image_root, metric, report) for path in trials_paths])
+    return dict(zip(trials_paths, outcomes))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score several trial files concurrently through one shared embedding pipeline.')
+    parser.add_argument('trials', nargs='+', help='trial CSVs')
+    parser.add_argument('--image-root', default=sdt.FILE_PATH)
+    parser.add_argument('--cache-dir', help='embedding cache directory (default: <image-root>/embedding_cache)')
+    parser.add_argument('--metric', choices=sdt.METRICS, default='euclidean')
+    parser.add_argument('--batch-size', type=int, default=sdt.EMBED_BATCH_SIZE)
+    args = parser.parse_args()
+
+    sdt.FILE_PATH = args.image_root
+    sdt.CACHE_DIR = args.cache_dir or os.path.join(args.image_root, 'embedding_cache')
+    for trials_path, (results, error_log) in asyncio.run(run_trial_sets(args.trials, args.image_root, args.metric,
+                                                                        args.batch_size)).items():
+        print(f"{trials_path}: accuracy {results['accuracy'].mean():.3f} over {len(results)} trials, {len(error_log)} errors")
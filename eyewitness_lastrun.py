@@ -411,6 +411,15 @@ def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
         right_image_list.append(row['right_image'])
         correct_position_list.append(row['correct_position'])
     
+    # decoded stimuli come from the packed bundle when one has been built (python stimulus_bundle.py .),
+    # otherwise the image components load the png files
+    from stimulus_bundle import open_bundle
+    stimulus_bundle = open_bundle(_thisDir)
+    
+    def stimulus_image(name):
+        bundled = stimulus_bundle.pil_image(name) if stimulus_bundle is not None else None
+        return bundled if bundled is not None else name
+    
     
     
     
@@ -682,7 +691,7 @@ def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
         ENCODE.status = NOT_STARTED
         continueRoutine = True
         # update component parameters for each repeat
-        image.setImage(encoding_image)
+        image.setImage(stimulus_image(encoding_image))
         # Run 'Begin Routine' code from code
         encoding_image = encoding_image_list[trial_loop.thisRepN]
         encoding_duration = encoding_duration_list[trial_loop.thisRepN]
@@ -939,8 +948,8 @@ def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
         TRIAL.status = NOT_STARTED
         continueRoutine = True
         # update component parameters for each repeat
-        left_image.setImage(left_image)
-        right_image.setImage(right_image)
+        left_image.setImage(stimulus_image(left_image))
+        right_image.setImage(stimulus_image(right_image))
         # create starting attributes for key_resp
         key_resp.keys = []
         key_resp.rt = []
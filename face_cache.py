@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks on windows, a cache directory is then safe for one process at a time
+    fcntl = None
+
+EMBEDDING_DIM = 512
+
+def file_hash(path):
+    # content hash so renamed or copied stimuli still hit the cache
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def config_hash(config):
+    # stable short hash of the pipeline settings an entry depends on
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+@contextmanager
+def locked(directory):
+    # exclusive lock on a cache directory, held by whichever process is appending rows or writing
+    # its index, so several processes (cli runs, worker pools, the embedding service) can share one
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(directory, 'lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+@contextmanager
+def replacing(path):
+    # a temporary path next to `path`, renamed over it once the block completes and removed if it fails,
+    # so readers never see a partial file. the name is unique per process and thread, so writers racing
+    # on one file (two runs starting at once) each write a whole copy of their own and the last rename wins
+    tmp_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def read_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+def write_json(path, data):
+    with replacing(path) as tmp_path, open(tmp_path, 'w') as f:
+        json.dump(data, f)
+
+class ArrayCache:
+    # on-disk store of fixed-shape arrays keyed by image content hash
+    # each pipeline config gets its own directory, so changing a detector or model
+    # setting only misses for that config and leaves every other entry valid
+    # rows live in one flat file that is read back through np.memmap; rows are appended at the real
+    # end of the file under the directory lock and each flush merges with the index on disk, so
+    # processes sharing a directory never hand out the same row. rows written by a run that never
+    # flushed are unreferenced and just take up space
+    def __init__(self, cache_dir, config, shape, dtype, data_name, read_only=False):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.row_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.read_only = read_only
+        self.path = os.path.join(cache_dir, config_hash(config))
+        self.index_path = os.path.join(self.path, 'index.json')
+        self.data_path = os.path.join(self.path, data_name)
+
+        self.index = read_json(self.index_path, {})
+
+        # read-only caches (e.g. in worker processes) never touch the files on disk
+        if not read_only:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, 'config.json'), 'w') as f:
+                json.dump(config, f, indent=2, sort_keys=True)
+            open(self.data_path, 'ab').close()
+
+        self._rows = None
+        self._dirty = False
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def _mapped(self, row):
+        # remap only when the file has grown past the current view
+        if self._rows is None or row >= self._rows.shape[0]:
+            self._rows = np.memmap(self.data_path, dtype=self.dtype, mode='r',
+                                   shape=(os.path.getsize(self.data_path) // self.row_bytes,) + self.shape)
+        return self._rows
+
+    def get(self, key):
+        row = self.index.get(key)
+        if row is None:
+            return None
+        return np.array(self._mapped(row)[row])
+
+    def put(self, key, value):
+        if key in self.index or self.read_only:
+            return
+        value = np.asarray(value, dtype=self.dtype).reshape(self.shape)
+        with locked(self.path), open(self.data_path, 'r+b') as f:
+            # the next whole row past the end, skipping any partial row an interrupted write left
+            row = -(-os.fstat(f.fileno()).st_size // self.row_bytes)
+            f.seek(row * self.row_bytes)
+            f.write(value.tobytes())
+        self.index[key] = row
+        self._dirty = True
+
+    def flush(self):
+        if not self._dirty:
+            return
+        with locked(self.path):
+            self.index = {**read_json(self.index_path, {}), **self.index}
+            self._write()
+        self._dirty = False
+
+    def _write(self):
+        # called under the lock with the merged index
+        write_json(self.index_path, self.index)
+
+class EmbeddingCache(ArrayCache):
+    # float32 facenet embeddings
+    def __init__(self, cache_dir, config, dim=EMBEDDING_DIM, read_only=False):
+        super().__init__(cache_dir, config, (dim,), np.float32, 'embeddings.f32', read_only)
+
+class CropCache(ArrayCache):
+    # 3 x image_size x image_size mtcnn face crops as uint8 pixels, which is lossless because
+    # mtcnn resizes crops in uint8 before standardising them; the detection tier that found each
+    # face is kept in tiers.json, only for faces that needed a retry tier
+    def __init__(self, cache_dir, config, image_size=160, read_only=False):
+        super().__init__(cache_dir, config, (3, image_size, image_size), np.uint8, 'crops.u8', read_only)
+        self.tiers_path = os.path.join(self.path, 'tiers.json')
+        self.tiers = read_json(self.tiers_path, {})
+
+    def tier(self, key):
+        if key not in self.index:
+            return None
+        return self.tiers.get(key, 0)
+
+    def put(self, key, value, tier=0):
+        if tier and key not in self.index and not self.read_only:
+            self.tiers[key] = tier
+        super().put(key, value)
+
+    def _write(self):
+        # tiers go first, a stray entry for a row the index never got is harmless
+        self.tiers = {**read_json(self.tiers_path, {}), **self.tiers}
+        write_json(self.tiers_path, self.tiers)
+        super()._write()
+
+class FailureRegistry:
+    # images the detector found no face in, keyed by content hash under one detector config, so a
+    # known failure is skipped without decoding it until the detector settings change; failures.json
+    # maps each hash to the last path it was seen at and when it first failed
+    def __init__(self, cache_dir, config, read_only=False):
+        self.read_only = read_only
+        self.path = os.path.join(cache_dir, config_hash(config))
+        self.registry_path = os.path.join(self.path, 'failures.json')
+        self.failures = read_json(self.registry_path, {})
+        if not read_only:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, 'config.json'), 'w') as f:
+                json.dump(config, f, indent=2, sort_keys=True)
+        self._dirty = False
+
+    def __len__(self):
+        return len(self.failures)
+
+    def __contains__(self, key):
+        return key in self.failures
+
+    def get(self, key):
+        return self.failures.get(key)
+
+    def add(self, key, image_path):
+        if self.read_only:
+            return
+        entry = self.failures.setdefault(key, {'path': image_path, 'recorded': time.strftime('%Y-%m-%dT%H:%M:%S')})
+        entry['path'] = image_path
+        self._dirty = True
+
+    def flush(self):
+        if not self._dirty:
+            return
+        with locked(self.path):
+            self.failures = {**read_json(self.registry_path, {}), **self.failures}
+            write_json(self.registry_path, self.failures)
+        self._dirty = False
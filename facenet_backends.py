@@ -0,0 +1,72 @@
+import copy
+import os
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from face_cache import replacing
+
+# alternative ways of running the float32 InceptionResnetV1 built by SDT_FACENET.load_facenet()
+
+QUANT_ENGINE = 'x86'
+CALIBRATION_BATCH_SIZE = 32
+
+# dummy batches run through traced or compiled models before any timed work
+WARMUP_RUNS = 3
+
+def quantize_int8(model, calibration_crops, batch_size=CALIBRATION_BATCH_SIZE):
+    # static int8 quantisation in FX graph mode: observers record activation ranges while real
+    # face crops pass through, then convs and linears are swapped for int8 kernels; dynamic
+    # quantisation would only cover nn.Linear, which is a sliver of facenet's cost
+    torch.backends.quantized.engine = QUANT_ENGINE
+    model = copy.deepcopy(model).cpu().eval()
+    prepared = prepare_fx(model, get_default_qconfig_mapping(QUANT_ENGINE),
+                          example_inputs=(calibration_crops[:1],))
+    with torch.inference_mode():
+        for start in range(0, len(calibration_crops), batch_size):
+            prepared(calibration_crops[start:start + batch_size])
+    return convert_fx(prepared).eval()
+
+class FixedBatch(torch.nn.Module):
+    # pads every call up to one fixed (batch_size, 3, 160, 160) shape so a traced or compiled
+    # graph is only ever specialised once; outputs for the padding rows are dropped
+    def __init__(self, model, batch_size, device):
+        super().__init__()
+        self.model = model
+        self.batch_size = batch_size
+        self.input_device = device
+
+    def forward(self, faces):
+        outputs = []
+        for start in range(0, len(faces), self.batch_size):
+            batch = faces[start:start + self.batch_size]
+            n = len(batch)
+            if n < self.batch_size:
+                batch = torch.cat([batch, batch.new_zeros((self.batch_size - n, *batch.shape[1:]))])
+            outputs.append(self.model(batch)[:n])
+        return torch.cat(outputs)
+
+def trace_facenet(load_model, batch_size, path, device):
+    # trace and freeze once at the fixed input shape and save the artefact, so later process
+    # starts load it instead of building and tracing the python model
+    if not os.path.exists(path):
+        example = torch.zeros(batch_size, 3, 160, 160, device=device)
+        with torch.no_grad():
+            frozen = torch.jit.freeze(torch.jit.trace(load_model(), example))
+        with replacing(path) as tmp_path:
+            torch.jit.save(frozen, tmp_path)
+    # the fused cpu kernels from optimize_for_inference do not serialise, so fuse after loading
+    model = torch.jit.optimize_for_inference(torch.jit.load(path, map_location=device))
+    return FixedBatch(model, batch_size, device)
+
+def compile_facenet(model, batch_size, cache_dir, device):
+    # torch.compile with static shapes; inductor keeps its generated kernels in cache_dir, so
+    # later process starts skip most of the compilation
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+    return FixedBatch(torch.compile(model, dynamic=False), batch_size, device)
+
+def warm_up(model, batch_size, device, runs=WARMUP_RUNS):
+    # compilation and executor specialisation happen on the first calls, get them out of the way
+    example = torch.zeros(batch_size, 3, 160, 160, device=device)
+    with torch.inference_mode():
+        for _ in range(runs):
+            model(example)
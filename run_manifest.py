@@ -0,0 +1,58 @@
+import json
+import os
+import pandas as pd
+from face_cache import config_hash, file_hash, replacing, write_json
+
+# record of the inputs behind the last machine run: the pipeline config, a content hash per stimulus
+# image (with its size and mtime, so unchanged files are not read again) and the outcome of every
+# trial row. rows are keyed by a hash of the row's values together with the hashes of its images, so
+# editing a row or replacing any image it shows gives it a new key and only those rows are re-scored
+
+MANIFEST_NAME = 'manifest.json'
+ROWS_NAME = 'manifest_rows.csv'
+# outcome stored per row; errors lists the images with no face ('encoding;target'), empty when scored
+ROW_COLUMNS = ['predicted', 'accuracy', 'dist_left', 'dist_right', 'margin', 'errors']
+
+def load_manifest(manifest_dir, config):
+    # previous image entries and row outcomes (indexed by row key), both empty when there is no
+    # manifest yet or it was written under a different pipeline config
+    empty = {}, pd.DataFrame(columns=ROW_COLUMNS, index=pd.Index([], name='row_key'))
+    manifest_path = os.path.join(manifest_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return empty
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest['config_hash'] != config_hash(config):
+        return empty
+    rows = pd.read_csv(os.path.join(manifest_dir, ROWS_NAME), index_col='row_key', dtype={'row_key': str},
+                       float_precision='round_trip')
+    rows['errors'] = rows['errors'].fillna('')
+    return manifest['images'], rows
+
+def save_manifest(manifest_dir, config, images, rows):
+    # rows first, the manifest naming the config is what makes them valid
+    os.makedirs(manifest_dir, exist_ok=True)
+    rows_path = os.path.join(manifest_dir, ROWS_NAME)
+    rows = rows[~rows.index.duplicated()]
+    with replacing(rows_path) as tmp_path:
+        rows[ROW_COLUMNS].to_csv(tmp_path, index_label='row_key')
+    write_json(os.path.join(manifest_dir, MANIFEST_NAME),
+               {'config_hash': config_hash(config), 'config': config, 'images': images})
+
+def hash_images(names, image_root, previous):
+    # name -> {'size', 'mtime_ns', 'hash'}; a file whose size and mtime match the previous entry keeps its hash
+    images = {}
+    for name in names:
+        stat = os.stat(os.path.join(image_root, name))
+        entry = previous.get(name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                     'hash': file_hash(os.path.join(image_root, name))}
+        images[name] = entry
+    return images
+
+def row_keys(loadouts, images, image_columns):
+    # 64-bit hash of each row's values plus the content hashes of the images it names
+    hashes = {name: entry['hash'] for name, entry in images.items()}
+    keyed = loadouts.assign(**{f'{column}_hash': loadouts[column].map(hashes) for column in image_columns})
+    return pd.util.hash_pandas_object(keyed, index=False).map('{:016x}'.format)
@@ -0,0 +1,147 @@
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+
+# per-stage wall time, item counts and memory for the embedding pipeline; SDT_FACENET only
+# calls into this when profiling is switched on, otherwise every stage is a shared no-op context
+
+PERCENTILES = (50, 90, 99)
+
+def peak_rss_mb():
+    # VmHWM where /proc exists: linux carries ru_maxrss over from the parent across exec, so in a
+    # spawned worker it would report the parent's peak; VmHWM starts fresh with the new process
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    # ru_maxrss is kilobytes on linux but bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def reset_peak_rss():
+    # restart VmHWM from the current rss (linux, writing 5 to clear_refs); False where that is not possible
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+class StageProfiler:
+    def __init__(self, trace_memory=False):
+        # tracemalloc sees python and numpy allocations but not torch's own allocator, so peak rss
+        # is the figure for model memory; it also slows allocation-heavy code, hence its own switch
+        self.trace_memory = trace_memory
+        self.latencies = {}
+        self.items = {}
+        self.peak_traced = {}
+        self.peak_rss = {}
+        self.counts = {}
+        # stages on decode threads update the same dicts as the main thread
+        self._lock = threading.Lock()
+        # running rss peaks of the main-thread stages currently open, innermost last, and of the whole
+        # profiled run, since resetting the high-water mark for one stage hides earlier peaks from VmHWM
+        self._open_peaks = []
+        reset_peak_rss()
+        self._process_peak = peak_rss_mb()
+        self.started = time.perf_counter()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _fold_peak(self):
+        # carry the high-water mark so far into every open stage and the run before it is reset
+        peak = peak_rss_mb()
+        self._open_peaks = [max(open_peak, peak) for open_peak in self._open_peaks]
+        self._process_peak = max(self._process_peak, peak)
+        return peak
+
+    @contextmanager
+    def stage(self, name, items=1):
+        # stages may run on decode threads, which run alongside the main thread's stages; memory
+        # peaks are only attributed on the main thread, where stages run one at a time. the rss
+        # high-water mark is reset on entry so each stage's peak is its own, not the run's so far
+        main_thread = threading.current_thread() is threading.main_thread()
+        track_rss = main_thread
+        if main_thread:
+            self._fold_peak()
+            track_rss = reset_peak_rss()
+            self._open_peaks.append(0)
+        track_memory = self.trace_memory and main_thread
+        if track_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if main_thread:
+                self._fold_peak()
+                stage_peak = self._open_peaks.pop()
+            with self._lock:
+                self.latencies.setdefault(name, []).append(elapsed)
+                self.items[name] = self.items.get(name, 0) + items
+                if track_rss:
+                    self.peak_rss[name] = max(self.peak_rss.get(name, 0), stage_peak)
+                if track_memory:
+                    peak = tracemalloc.get_traced_memory()[1] / 2**20
+                    self.peak_traced[name] = max(self.peak_traced.get(name, 0), peak)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def records(self):
+        # raw measurements, picklable so worker processes can send theirs back to be merged
+        return {'latencies': self.latencies, 'items': self.items, 'peak_traced': self.peak_traced,
+                'peak_rss': self.peak_rss, 'counts': self.counts}
+
+    def process_peak_rss(self):
+        # peak rss since profiling started, VmHWM alone only covers the time since the last stage began
+        return max(self._process_peak, peak_rss_mb())
+
+    def merge(self, records):
+        with self._lock:
+            self._merge(records)
+
+    def _merge(self, records):
+        for name, latencies in records['latencies'].items():
+            self.latencies.setdefault(name, []).extend(latencies)
+        for name, n in records['items'].items():
+            self.items[name] = self.items.get(name, 0) + n
+        for name, n in records['counts'].items():
+            self.counts[name] = self.counts.get(name, 0) + n
+        for field in ['peak_traced', 'peak_rss']:
+            peaks = getattr(self, field)
+            for name, peak in records[field].items():
+                peaks[name] = max(peaks.get(name, 0), peak)
+
+    def summary(self):
+        # latency percentiles are per call (one image for decode, one batch for the models);
+        # time is summed across threads and processes, so stages can add up to more than wall time
+        stages = {}
+        for name, latencies in self.latencies.items():
+            ms = np.array(latencies) * 1000
+            total = ms.sum() / 1000
+            stages[name] = {
+                'calls': len(ms),
+                'items': self.items[name],
+                'total_s': total,
+                'ms_per_item': ms.sum() / max(self.items[name], 1),
+                'items_per_sec': self.items[name] / total if total else None,
+                **{f'p{p}_ms': float(np.percentile(ms, p)) for p in PERCENTILES},
+                'peak_rss_mb': self.peak_rss.get(name),
+                'peak_traced_mb': self.peak_traced.get(name)
+            }
+        return {
+            'wall_s': time.perf_counter() - self.started,
+            'peak_rss_mb': self.process_peak_rss(),
+            'counts': dict(self.counts),
+            'stages': stages
+        }
@@ -0,0 +1,127 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import numpy as np
+from PIL import Image
+from face_cache import file_hash, replacing, write_json
+
+# the stimulus set decoded once and packed into one flat uint8 file (pixels.u8) with an index of
+# each image's offset, shape and mode (index.json), kept in <image_root>/stimulus_bundle/. the pixel
+# file is memory-mapped, so getting an image is a slice of the map rather than an open and png decode,
+# and every process sharing it shares the page cache. only numpy and PIL are needed, so the psychopy
+# scripts can load it too. each entry records its png's size and mtime: a png changed after the
+# bundle was built is not served from it, and callers fall back to the file
+
+BUNDLE_DIR = 'stimulus_bundle'
+# modes kept as they are, anything else (palette, greyscale with alpha, ...) is stored as RGBA
+BUNDLE_MODES = ('L', 'RGB', 'RGBA')
+
+def build_bundle(image_root, names=None, pattern='*.png', bundle_dir=None):
+    # decode every image (or just `names`, relative to image_root) and write the bundle; returns its index
+    bundle_dir = bundle_dir or os.path.join(image_root, BUNDLE_DIR)
+    if names is None:
+        names = sorted(os.path.relpath(path, image_root) for path in glob.glob(os.path.join(image_root, pattern)))
+    os.makedirs(bundle_dir, exist_ok=True)
+    pixels_path = os.path.join(bundle_dir, 'pixels.u8')
+
+    images = {}
+    offset = 0
+    # pixels first, the index naming their offsets is what makes them valid
+    with replacing(pixels_path) as tmp_path, open(tmp_path, 'wb') as f:
+        for name in names:
+            path = os.path.join(image_root, name)
+            stat = os.stat(path)
+            with Image.open(path) as img:
+                img = img if img.mode in BUNDLE_MODES else img.convert('RGBA')
+                pixels = np.asarray(img, dtype=np.uint8)
+            f.write(pixels.tobytes())
+            images[name] = {'offset': offset, 'shape': list(pixels.shape), 'mode': img.mode,
+                            'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': file_hash(path)}
+            offset += pixels.nbytes
+    index = {'bytes': offset, 'images': images}
+    write_json(os.path.join(bundle_dir, 'index.json'), index)
+    return index
+
+def open_bundle(image_root, bundle_dir=None):
+    # the bundle for image_root, None if none has been built
+    bundle_dir = bundle_dir or os.path.join(image_root, BUNDLE_DIR)
+    if not os.path.exists(os.path.join(bundle_dir, 'index.json')):
+        return None
+    return StimulusBundle(image_root, bundle_dir)
+
+class StimulusBundle:
+    def __init__(self, image_root, bundle_dir=None):
+        self.image_root = image_root
+        self.bundle_dir = bundle_dir or os.path.join(image_root, BUNDLE_DIR)
+        with open(os.path.join(self.bundle_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.images = index['images']
+        # np.memmap refuses empty files
+        self._pixels = (np.memmap(os.path.join(self.bundle_dir, 'pixels.u8'), dtype=np.uint8, mode='r',
+                                  shape=(index['bytes'],)) if index['bytes'] else np.empty(0, dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.images)
+
+    def __contains__(self, name):
+        return name in self.images
+
+    def entry(self, name):
+        # index entry of an image whose png is unchanged since the bundle was built (or no longer
+        # exists, the bundle is then the only copy), None otherwise
+        entry = self.images.get(name)
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(os.path.join(self.image_root, name))
+        except FileNotFoundError:
+            return entry
+        if stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime_ns']:
+            return None
+        return entry
+
+    def get(self, name):
+        # read-only (height, width[, channels]) view into the map, no copy and no decode
+        entry = self.entry(name)
+        if entry is None:
+            return None
+        n_bytes = int(np.prod(entry['shape']))
+        return self._pixels[entry['offset']:entry['offset'] + n_bytes].reshape(entry['shape'])
+
+    def pil_image(self, name):
+        # PIL image over the same memory (PIL shares L and RGBA buffers, RGB is copied), which
+        # psychopy's ImageStim.setImage() takes in place of a file name
+        pixels = self.get(name)
+        if pixels is None:
+            return None
+        mode = self.images[name]['mode']
+        return Image.frombuffer(mode, (pixels.shape[1], pixels.shape[0]), pixels, 'raw', mode, 0, 1)
+
+    def hash(self, name):
+        # the png's content hash as recorded at build time, the cache key file_hash() would give
+        entry = self.entry(name)
+        return entry['hash'] if entry is not None else None
+
+    def stale(self):
+        # bundled images whose png has changed since the build
+        return [name for name in self.images if self.entry(name) is None]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the decoded stimulus images into one memory-mapped bundle.')
+    parser.add_argument('image_root', help='directory of stimulus images, the bundle is written to <image_root>/stimulus_bundle')
+    parser.add_argument('--pattern', default='*.png', help='images to pack (default: %(default)s)')
+    parser.add_argument('--trials', help='only pack the images a trial CSV names')
+    args = parser.parse_args()
+
+    names = None
+    if args.trials:
+        import pandas as pd
+        from SDT_FACENET import IMAGE_COLUMNS
+        names = list(pd.unique(pd.read_csv(args.trials)[IMAGE_COLUMNS].values.ravel()))
+    start = time.perf_counter()
+    index = build_bundle(args.image_root, names, args.pattern)
+    print(f"packed {len(index['images'])} images ({index['bytes'] / 2**20:.1f} MB) in "
+          f"{time.perf_counter() - start:.2f}s", file=sys.stderr)
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import SDT_FACENET as sdt
+from trial_scoring import score_trials
+
+def make_loadouts():
+    # three encoding/target/innocent sets, each trial shows the target and innocent image
+    return pd.DataFrame({
+        'encoding_image': ['suspect1.png', 'suspect2.png', 'suspect3.png'],
+        'target_image': ['target1.png', 'target2.png', 'target3.png'],
+        'innocent_image': ['innocent1.png', 'innocent2.png', 'innocent3.png'],
+        'correct_position': ['left', 'right', 'left'],
+        'left_image': ['target1.png', 'innocent2.png', 'target3.png'],
+        'right_image': ['innocent1.png', 'target2.png', 'innocent3.png']
+    })
+
+def make_embeddings(names, seed=0):
+    rng = np.random.default_rng(seed)
+    matrix = rng.standard_normal((len(names), 512)).astype(np.float32)
+    return matrix, {name: i for i, name in enumerate(names)}
+
+def test_left_right_without_face_is_logged():
+    loadouts = make_loadouts()
+    loadouts.loc[1, 'left_image'] = 'blank.png'
+    matrix, rows = make_embeddings(pd.unique(loadouts[sdt.IMAGE_COLUMNS].values.ravel()))
+    del rows['blank.png']
+    results, error_log = sdt.score_loadouts(loadouts, matrix, rows)
+    assert list(results['trial']) == [0, 2]
+    assert error_log == ['1 - left face not detected']
+
+def test_missing_target_is_logged_once():
+    # left repeats the target, so only the target is reported
+    loadouts = make_loadouts()
+    matrix, rows = make_embeddings(pd.unique(loadouts[sdt.IMAGE_COLUMNS].values.ravel()))
+    del rows['target1.png']
+    results, error_log = sdt.score_loadouts(loadouts, matrix, rows)
+    assert list(results['trial']) == [1, 2]
+    assert error_log == ['0 - target face not detected']
+
+def test_distances_do_not_depend_on_chunking():
+    matrix, _ = make_embeddings(range(50), seed=1)
+    rng = np.random.default_rng(2)
+    encoding, left, right = rng.integers(0, 50, (3, 200))
+    correct_left = rng.random(200) < 0.5
+    for metric in sdt.METRICS:
+        full = score_trials(matrix, encoding, left, right, correct_left, metric)
+        for start in range(0, 200, 7):
+            # each chunk scored over a table of just its own images, in another order
+            images = np.unique(np.concatenate([encoding[start:start + 7], left[start:start + 7], right[start:start + 7]]))[::-1]
+            position = {image: i for i, image in enumerate(images)}
+            chunk = score_trials(matrix[images], *[[position[image] for image in idx[start:start + 7]]
+                                                   for idx in (encoding, left, right)],
+                                 correct_left[start:start + 7], metric)
+            for name in ['dist_left', 'dist_right', 'margin']:
+                assert np.array_equal(chunk[name], full[name][start:start + 7])
+
+def test_incremental_matches_full_run(tmp_path, monkeypatch):
+    loadouts = make_loadouts()
+    loadouts.loc[1, 'left_image'] = 'blank.png'
+    names = pd.unique(loadouts[sdt.IMAGE_COLUMNS].values.ravel())
+    for i, name in enumerate(names):
+        (tmp_path / name).write_bytes(bytes([i]))
+    trials_path = tmp_path / 'trials.csv'
+    loadouts.to_csv(trials_path, index=False)
+    matrix, rows = make_embeddings(names)
+    embeddings = {str(tmp_path / name): None if name == 'blank.png' else matrix[rows[name]] for name in names}
+    monkeypatch.setattr(sdt, 'embed_images', lambda paths, *args, **kwargs: {path: embeddings[path] for path in paths})
+    monkeypatch.setattr(sdt, 'embedding_config', lambda: {})
+
+    full, full_errors = sdt.run_trials(trials_path=trials_path, image_root=str(tmp_path))
+    for n_rescored in [3, 0]:
+        results, error_log, rescored = sdt.run_trials_incremental(trials_path=trials_path, image_root=str(tmp_path),
+                                                                  manifest_dir=str(tmp_path / 'manifest'))
+        assert rescored == n_rescored
+        pd.testing.assert_frame_equal(results, full)
+        assert error_log == full_errors == ['1 - left face not detected']
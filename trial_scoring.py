@@ -0,0 +1,126 @@
+import hashlib
+import os
+import numpy as np
+from face_cache import replacing
+
+METRICS = ('euclidean', 'cosine')
+
+# every trial distance is computed from its two embedding rows in float64, so it depends only on the
+# two images and never on which other trials or images it is scored with: chunked, streamed,
+# incremental and full runs give the same distance to the bit. pairs repeat heavily (left and right
+# are always the target and innocent image), so each distinct pair is computed once, CHUNK_PAIRS at a
+# time, and a handful of trials over a large gallery never builds an n^2 matrix
+CHUNK_PAIRS = 65536
+
+# rows of the all-pairs matrix computed per step, bounds temporaries to BLOCK_SIZE x n_images
+BLOCK_SIZE = 1024
+
+def distance_function(embeddings, metric='euclidean'):
+    # returns f(a_idx, b_idx) giving the distance between embeddings[a_idx[k]] and embeddings[b_idx[k]]
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric!r}, expected one of {METRICS}")
+    embeddings = np.asarray(embeddings)
+    n_images = max(len(embeddings), 1)
+
+    def distances(a_idx, b_idx):
+        pairs, inverse = np.unique(np.asarray(a_idx, dtype=np.int64) * n_images + np.asarray(b_idx, dtype=np.int64),
+                                   return_inverse=True)
+        a_idx, b_idx = np.divmod(pairs, n_images)
+        out = np.empty(len(pairs))
+        for start in range(0, len(pairs), CHUNK_PAIRS):
+            # rows are widened after the gather, the table itself is never copied
+            a = embeddings[a_idx[start:start + CHUNK_PAIRS]].astype(np.float64)
+            b = embeddings[b_idx[start:start + CHUNK_PAIRS]].astype(np.float64)
+            if metric == 'euclidean':
+                a -= b
+                out[start:start + len(a)] = np.sqrt(np.einsum('ij,ij->i', a, a))
+            else:
+                out[start:start + len(a)] = 1 - np.einsum('ij,ij->i', a, b) / np.sqrt(
+                    np.einsum('ij,ij->i', a, a) * np.einsum('ij,ij->i', b, b))
+        return out[inverse]
+    return distances
+
+def score_trials(embeddings, encoding_idx, left_idx, right_idx, correct_left, metric='euclidean'):
+    # score every 2AFC trial at once from an (n_images, 512) embedding matrix and
+    # integer row indices for the encoding, left and right image of each trial
+    distances = distance_function(embeddings, metric)
+    dist_left = distances(encoding_idx, left_idx)
+    dist_right = distances(encoding_idx, right_idx)
+
+    # same decision rule as the per-trial loop: ties go to the right image
+    predicted_left = dist_left < dist_right
+    correct_left = np.asarray(correct_left, dtype=bool)
+
+    # positive margin means the correct face was closer by that much
+    margin = np.where(correct_left, dist_right - dist_left, dist_left - dist_right)
+
+    return {
+        'dist_left': dist_left,
+        'dist_right': dist_right,
+        'predicted_left': predicted_left,
+        'accuracy': (predicted_left == correct_left).astype(int),
+        'margin': margin
+    }
+
+def pairwise_distance_matrix(embeddings, metric='euclidean', block_size=BLOCK_SIZE, out=None):
+    # all-pairs distances between gallery images, filled one block of rows at a time;
+    # pass a np.memmap as `out` to keep the matrix on disk for large galleries
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric!r}, expected one of {METRICS}")
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    n = len(embeddings)
+    if out is None:
+        out = np.empty((n, n), dtype=np.float32)
+
+    gallery = embeddings.astype(np.float64)
+    sq_norms = np.einsum('ij,ij->i', gallery, gallery)
+    for start in range(0, n, block_size):
+        block = gallery[start:start + block_size]
+        dot = block @ gallery.T
+        if metric == 'euclidean':
+            dist = np.sqrt(np.maximum(sq_norms[start:start + len(block), None] + sq_norms[None, :] - 2 * dot, 0))
+        else:
+            dist = 1 - dot / np.sqrt(sq_norms[start:start + len(block), None] * sq_norms[None, :])
+        out[start:start + len(block)] = dist
+    return out
+
+def cached_distance_matrix(embeddings, cache_dir, metric='euclidean', block_size=BLOCK_SIZE):
+    # the matrix is stored as .npy named after the embedding bytes and metric, and reopened
+    # memory-mapped so repeated lineup simulations never recompute distances
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    digest = hashlib.sha256(embeddings.tobytes()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f'distances-{metric}-{len(embeddings)}-{digest}.npy')
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        with replacing(path) as tmp_path:
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                            shape=(len(embeddings), len(embeddings)))
+            pairwise_distance_matrix(embeddings, metric, block_size, out)
+            out.flush()
+            del out
+    return np.load(path, mmap_mode='r')
+
+def score_lineups(distances, encoding_idx, lineup_idx, target_pos):
+    # score n-alternative lineups by indexing into a precomputed distance matrix
+    # lineup_idx is (n_lineups, n_alternatives) gallery rows, target_pos the column holding the culprit
+    encoding_idx = np.asarray(encoding_idx)
+    lineup_idx = np.asarray(lineup_idx)
+    target_pos = np.asarray(target_pos)
+    lineup_distances = np.asarray(distances[encoding_idx[:, None], lineup_idx])
+
+    # the witness picks the lineup member closest to the encoded face
+    chosen = lineup_distances.argmin(axis=1)
+    rows = np.arange(len(lineup_idx))
+    target_distance = lineup_distances[rows, target_pos]
+
+    # positive margin means the culprit beat the closest foil by that much
+    foil_distances = lineup_distances.copy()
+    foil_distances[rows, target_pos] = np.inf
+    margin = foil_distances.min(axis=1) - target_distance
+
+    return {
+        'lineup_distances': lineup_distances,
+        'chosen': chosen,
+        'accuracy': (chosen == target_pos).astype(int),
+        'margin': margin
+    }